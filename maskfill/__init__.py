@@ -1 +1,28 @@
-from .maskfill import *
+import sys
+import types
+import importlib
+
+__version__ = "1.1.1"
+
+# public names, and the modules that define them; they are imported on first use, so that importing the
+# package (e.g. for the command line tools, see `maskfill.command_line`) does not import numpy
+_EXPORTS = {'find_nan_indices': 'maskfill', 'process_masked_pixels': 'maskfill', 'maskfill': 'maskfill', 'FillStats': 'maskfill',
+            'MaskFiller': 'maskfill', 'iteration_map': 'maskfill', 'cli': 'maskfill', 'find_batch_jobs': 'batch', 'run_batch': 'batch',
+            'ResultCache': 'cache'}
+__all__ = list(_EXPORTS) + ['__version__']
+
+
+def __getattr__(name:str):
+    if name not in _EXPORTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_EXPORTS[name]}', __name__), name)
+    globals()[name] = value
+    if isinstance(globals().get('maskfill'), types.ModuleType):
+        # importing the submodule maskfill.maskfill (here, or from e.g. maskfill.batch) sets the package attribute
+        # `maskfill` to it; the attribute is the `maskfill` function, as when the package imported everything eagerly
+        globals()['maskfill'] = sys.modules[f'{__name__}.maskfill'].maskfill
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,261 @@
+from typing import Union, List, Tuple
+import os
+import glob
+import time
+import queue
+import threading
+import numpy as np
+from .maskfill import maskfill, FillStats, _map_jobs, _n_threads, _write_output, _cache_summary
+from .cache import _as_cache
+
+
+def find_batch_jobs(manifest : str = None,
+                    inputs : Union[str, List[str]] = None,
+                    input_dir : str = None,
+                    pattern : str = '*.fits',
+                    mask : str = None,
+                    mask_dir : str = None,
+                    output_dir : str = None):
+    """Collect the (input, mask, output) file triples of a batch run.
+
+    Parameters
+    ----------
+    manifest : str, optional
+        text file with one `input mask output` triple per line (blank lines and lines starting with # are skipped).
+        If given, all other arguments are ignored, by default None
+    inputs : Union[str, List[str]], optional
+        glob pattern(s) matching the input images, by default None
+    input_dir : str, optional
+        directory with input images, selected with `pattern`, by default None
+    pattern : str, optional
+        glob pattern for the files in `input_dir`, by default '*.fits'
+    mask : str, optional
+        a single mask file shared by all inputs, by default None
+    mask_dir : str, optional
+        directory with one mask per input, with the same file name as the input, by default None
+    output_dir : str, optional
+        directory for the outputs, which get the same file name as their input, by default None
+
+    Returns
+    -------
+    List[Tuple[str, str, str]]
+        (input, mask, output) paths, sorted by input path unless read from a manifest
+    """
+    if manifest is not None:
+        jobs = []
+        with open(manifest) as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                fields = line.split()
+                if len(fields) != 3:
+                    raise ValueError(f'{manifest}, line {line_number}: expected "input mask output", got "{line}"')
+                jobs.append(tuple(fields))
+        return jobs
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    paths = set()
+    for input_pattern in inputs or []:
+        paths.update(glob.glob(input_pattern))
+    if input_dir is not None:
+        paths.update(glob.glob(os.path.join(input_dir, pattern)))
+    if (mask is None) == (mask_dir is None):
+        raise ValueError('Provide either a shared mask or a mask directory.')
+    if output_dir is None:
+        raise ValueError('An output directory is required unless a manifest is used.')
+    jobs = []
+    for path in sorted(paths):
+        name = os.path.basename(path)
+        output = os.path.join(output_dir, name)
+        if os.path.abspath(output) == os.path.abspath(path):
+            raise ValueError(f'Output for {path} would overwrite the input; choose another output directory.')
+        jobs.append((path, mask if mask is not None else os.path.join(mask_dir, name), output))
+    return jobs
+
+
+def run_batch(jobs : List[Tuple[str, str, str]],
+              n_jobs : int = 1,
+              progress : bool = True,
+              profile : bool = False,
+              queue_depth : int = 0,
+              **kwargs):
+    """Run `maskfill` on every (input, mask, output) triple in one process.
+
+    A frame that fails is reported and skipped; it does not abort the run.
+
+    With `queue_depth` > 0, reading, filling and writing run as a pipeline: a reader thread loads the
+    next frames (and their masks) while the current ones are filled, and a writer thread saves the
+    finished frames, so that the run takes about as long as the slowest of the three stages instead of
+    their sum (e.g., when reading and writing go over a network filesystem). At most `queue_depth` frames
+    wait between two stages, which bounds the memory use to about 2 * queue_depth + n_jobs frames.
+
+    Parameters
+    ----------
+    jobs : List[Tuple[str, str, str]]
+        (input, mask, output) paths, e.g. from `find_batch_jobs`
+    n_jobs : int, optional
+        number of frames processed concurrently on a thread pool (-1 uses all cores), by default 1
+    progress : bool, optional
+        print one line per finished frame with its timing, and a summary at the end, by default True
+    profile : bool, optional
+        add a 'profile' entry to each record with the `FillStats` report of the frame, by default False
+    queue_depth : int, optional
+        number of frames read ahead, and of filled frames waiting to be written, by default 0 (no pipeline: each
+        frame is read, filled and written in turn). Only for single extensions, without `low_memory` and `strip_rows`.
+    **kwargs
+        passed on to `maskfill` (e.g. `size`, `operator`, `smooth`); a `cache` is shared by all frames, and its hits and misses are
+        printed with the summary
+
+    Returns
+    -------
+    List[dict]
+        one record per job, in the order of `jobs`, with keys 'input', 'mask', 'output',
+        'seconds' and 'error' (None on success, else the error message), and 'profile' if requested
+    """
+    if kwargs.get('cache') is not None:
+        # one cache object for all frames, which counts their hits and misses
+        kwargs['cache'] = _as_cache(kwargs['cache'])
+    if queue_depth:
+        return _run_pipeline(jobs, n_jobs=n_jobs, progress=progress, profile=profile, queue_depth=queue_depth, **kwargs)
+    lock = threading.Lock()
+    finished = [0]
+    start = time.perf_counter()
+
+    def run_job(job):
+        input_image, mask, output_file = job
+        stats = FillStats() if profile else None
+        t0 = time.perf_counter()
+        try:
+            # only the output file is kept, so the unsmoothed image need not be returned
+            maskfill(input_image, mask, output_file=output_file, stats=stats, **{'keep_unsmoothed': False, **kwargs})
+            error = None
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        record = dict(input=input_image, mask=mask, output=output_file,
+                      seconds=time.perf_counter() - t0, error=error)
+        if profile:
+            record['profile'] = stats.to_dict()
+        if progress:
+            with lock:
+                finished[0] += 1
+                status = 'FAILED: ' + error if error else f'{record["seconds"]:.2f} s'
+                print(f'[{finished[0]}/{len(jobs)}] {input_image} -> {output_file} | {status}', flush=True)
+        return record
+
+    records = _map_jobs(run_job, jobs, n_jobs)
+    if progress:
+        _print_summary(records, time.perf_counter() - start, kwargs.get('cache'))
+    return records
+
+
+def _print_summary(records:List[dict], seconds:float, cache=None):
+    n_failed = sum(record['error'] is not None for record in records)
+    print(f'Processed {len(records)} frames in {seconds:.2f} s ({n_failed} failed).')
+    if cache is not None:
+        print(_cache_summary(cache))
+
+
+def _read_frame(input_image:str, mask:str, ext:int, masks:dict):
+    """Read an image and its mask into memory, as `maskfill` would; `masks` keeps the last mask read, for a shared mask."""
+    from astropy.io import fits
+    if not input_image.endswith('.fits'):
+        input_image+='.fits'
+    if not mask.endswith('.fits'):
+        mask+='.fits'
+    # no memory map: the data must be read here, not when the fill first touches them
+    image = fits.getdata(input_image, ext, memmap=False)
+    if masks.get('name') != (mask, ext):
+        masks.clear()
+        masks['array'] = np.array(fits.getdata(mask, ext, memmap=False), dtype=bool)
+        masks['name'] = (mask, ext)
+    return image, masks['array']
+
+
+def _run_pipeline(jobs:List[Tuple[str, str, str]], n_jobs:int = 1, progress:bool = True, profile:bool = False,
+                  queue_depth:int = 1, **kwargs):
+    """`run_batch` with reading, filling and writing overlapped: one reader thread, `n_jobs` fill threads and the
+    calling thread as writer, connected by queues of at most `queue_depth` frames."""
+    ext = kwargs.get('ext', 0)
+    if isinstance(ext, (list, tuple)) or ext == 'all' or kwargs.get('low_memory') or kwargs.get('strip_rows') is not None:
+        raise ValueError('queue_depth is only supported for a single extension, without low_memory or strip_rows.')
+    if queue_depth < 0:
+        raise ValueError('queue_depth must be a positive integer, or 0 for no pipeline.')
+    n_jobs = min(_n_threads(n_jobs), max(len(jobs), 1))
+    smooth = kwargs.get('smooth', True)
+    verbose = kwargs.get('verbose', False)
+    # the unsmoothed image is written to the output file, so it is always kept
+    kwargs = {key: value for key, value in kwargs.items() if key not in ['ext', 'low_memory', 'strip_rows', 'keep_unsmoothed']}
+    read_queue = queue.Queue(maxsize=queue_depth)
+    write_queue = queue.Queue(maxsize=queue_depth)
+    start = time.perf_counter()
+
+    def read_frames():
+        masks = {}
+        for index, (input_image, mask, output_file) in enumerate(jobs):
+            # every stage fills in the same record; 'seconds' adds up the time the frame spent in each of them
+            record = dict(input=input_image, mask=mask, output=output_file, seconds=0.0, error=None)
+            stats = FillStats()
+            frame = None
+            t0 = time.perf_counter()
+            try:
+                with stats.timer('read'):
+                    frame = _read_frame(input_image, mask, ext, masks)
+            except Exception as e:
+                record['error'] = f'{type(e).__name__}: {e}'
+            record['seconds'] += time.perf_counter() - t0
+            read_queue.put((index, record, stats, frame))
+        for _ in range(n_jobs):
+            read_queue.put(None)
+
+    def fill_frames():
+        while True:
+            item = read_queue.get()
+            if item is None:
+                break
+            index, record, stats, frame = item
+            result = None
+            if record['error'] is None:
+                t0 = time.perf_counter()
+                try:
+                    result = maskfill(*frame, stats=stats, **kwargs)
+                except Exception as e:
+                    record['error'] = f'{type(e).__name__}: {e}'
+                record['seconds'] += time.perf_counter() - t0
+            # drop the input before waiting for the writer
+            item = frame = None
+            write_queue.put((index, record, stats, result))
+
+    threads = [threading.Thread(target=read_frames, daemon=True)]
+    threads += [threading.Thread(target=fill_frames, daemon=True) for _ in range(n_jobs)]
+    for thread in threads:
+        thread.start()
+    records = [None] * len(jobs)
+    for finished in range(1, len(jobs) + 1):
+        index, record, stats, result = write_queue.get()
+        if record['error'] is None:
+            t0 = time.perf_counter()
+            try:
+                _write_output(record['output'], result, smooth=smooth, verbose=verbose, stats=stats)
+            except Exception as e:
+                record['error'] = f'{type(e).__name__}: {e}'
+            record['seconds'] += time.perf_counter() - t0
+        result = None
+        if profile:
+            record['profile'] = stats.to_dict()
+        records[index] = record
+        if progress:
+            status = 'FAILED: ' + record['error'] if record['error'] else f'{record["seconds"]:.2f} s'
+            print(f'[{finished}/{len(jobs)}] {record["input"]} -> {record["output"]} | {status}', flush=True)
+    for thread in threads:
+        thread.join()
+    if progress:
+        _print_summary(records, time.perf_counter() - start, kwargs.get('cache'))
+    return records
+
+
+# the command line tool, see `maskfill.command_line`
+from .command_line import batch_cli as cli
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,288 @@
+"""Benchmarks of maskfill on synthetic images and masks.
+
+Run `python -m maskfill.bench -h` for the options; the results are written as JSON so that
+runs of different versions can be compared.
+"""
+from typing import List, Tuple
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+from .maskfill import maskfill, FillStats, __version__
+
+
+def synthetic_image(shape : Tuple[int, int], seed : int = 0):
+    """Synthetic sky image: a smooth background, a few hundred Gaussian sources and noise (float32).
+
+    Parameters
+    ----------
+    shape : Tuple[int, int]
+        image shape
+    seed : int, optional
+        random seed, by default 0
+
+    Returns
+    -------
+    np.ndarray
+        the image
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = 10 + 5 * np.sin(x / width * np.pi) * np.cos(y / height * np.pi)
+    n_sources = max(1, height * width // 20000)
+    for yc, xc, flux, sigma in zip(rng.uniform(0, height, n_sources), rng.uniform(0, width, n_sources),
+                                   rng.lognormal(3, 1, n_sources), rng.uniform(1, 6, n_sources)):
+        r = int(5 * sigma)
+        ys = slice(max(int(yc) - r, 0), min(int(yc) + r + 1, height))
+        xs = slice(max(int(xc) - r, 0), min(int(xc) + r + 1, width))
+        image[ys, xs] += flux * np.exp(-((y[ys, xs] - yc)**2 + (x[ys, xs] - xc)**2) / (2 * sigma**2))
+    image += rng.normal(0, 1, shape).astype(np.float32)
+    return image.astype(np.float32)
+
+
+def cosmic_ray_mask(shape : Tuple[int, int], coverage : float = 0.001, seed : int = 0):
+    """Speckle of small (1 to 3 pixel wide) cosmic-ray hits covering about `coverage` of the image."""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=bool)
+    n_hits = max(1, int(coverage * mask.size / 4))
+    ys = rng.integers(0, shape[0], n_hits)
+    xs = rng.integers(0, shape[1], n_hits)
+    for dy, dx in [(0, 0), (0, 1), (1, 0), (1, 1), (-1, 0), (0, -1)]:
+        keep = rng.random(n_hits) < (1 if (dy, dx) == (0, 0) else 0.5)
+        mask[np.clip(ys[keep] + dy, 0, shape[0] - 1), np.clip(xs[keep] + dx, 0, shape[1] - 1)] = True
+    return mask
+
+
+def trail_mask(shape : Tuple[int, int], coverage : float = 0.01, seed : int = 0, width : int = 15):
+    """Straight satellite trails of `width` pixels crossing the image, covering about `coverage` of it."""
+    rng = np.random.default_rng(seed)
+    height, image_width = shape
+    y, x = np.mgrid[0:height, 0:image_width]
+    mask = np.zeros(shape, dtype=bool)
+    n_trails = max(1, int(round(coverage * height * image_width / (width * np.hypot(height, image_width)))))
+    for _ in range(n_trails):
+        angle = rng.uniform(0, np.pi)
+        yc, xc = rng.uniform(0, height), rng.uniform(0, image_width)
+        mask |= np.abs((x - xc) * np.sin(angle) - (y - yc) * np.cos(angle)) < width / 2
+    return mask
+
+
+def star_mask(shape : Tuple[int, int], coverage : float = 0.01, seed : int = 0, max_radius : int = 100):
+    """Circular bright-star masks with radii up to `max_radius`, covering about `coverage` of the image."""
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    mask = np.zeros(shape, dtype=bool)
+    target = coverage * mask.size
+    while mask.sum() < target:
+        radius = rng.uniform(max_radius / 5, max_radius)
+        yc, xc = rng.uniform(0, height), rng.uniform(0, width)
+        ys = slice(max(int(yc - radius), 0), min(int(yc + radius) + 1, height))
+        xs = slice(max(int(xc - radius), 0), min(int(xc + radius) + 1, width))
+        y, x = np.mgrid[ys, xs]
+        mask[ys, xs] |= (y - yc)**2 + (x - xc)**2 <= radius**2
+    return mask
+
+
+def random_mask(shape : Tuple[int, int], coverage : float = 0.01, seed : int = 0):
+    """Independently masked random pixels covering `coverage` of the image."""
+    return np.random.default_rng(seed).random(shape) < coverage
+
+
+MASKS = {'cosmics': cosmic_ray_mask, 'trails': trail_mask, 'stars': star_mask, 'random': random_mask}
+
+
+def _rms(differences:np.ndarray):
+    """Root mean square of the finite `differences` (in float64), or None if there are none."""
+    differences = differences[np.isfinite(differences)].astype(np.float64)
+    return float(np.sqrt(np.mean(differences**2))) if differences.size else None
+
+
+def run_benchmark(shape : Tuple[int, int] = (1024, 1024),
+                  masks : List[str] = ('cosmics', 'trails', 'stars', 'random'),
+                  coverages : List[float] = (0.001, 0.01, 0.1, 0.5),
+                  sizes : List[int] = (3, 5),
+                  operators : List[str] = ('median', 'mean'),
+                  smooth : List[bool] = (True, False),
+                  methods : List[str] = ('iterative',),
+                  repeat : int = 3,
+                  seed : int = 0,
+                  memory : bool = True,
+                  verbose : bool = False,
+                  **kwargs):
+    """Time `maskfill` for every combination of mask type, coverage, size, operator and smoothing.
+
+    Parameters
+    ----------
+    shape : Tuple[int, int], optional
+        shape of the synthetic image, by default (1024, 1024)
+    masks : List[str], optional
+        mask types, keys of `MASKS`, by default all of them
+    coverages : List[float], optional
+        fractions of the image to mask, by default (0.001, 0.01, 0.1, 0.5)
+    sizes : List[int], optional
+        maskfill `size` values, by default (3, 5)
+    operators : List[str], optional
+        maskfill `operator` values, by default ('median', 'mean')
+    smooth : List[bool], optional
+        maskfill `smooth` values, by default (True, False)
+    methods : List[str], optional
+        maskfill `method` values, by default ('iterative',)
+    repeat : int, optional
+        number of timed runs per combination; the fastest is reported, by default 3
+    seed : int, optional
+        random seed for the image and masks, by default 0
+    memory : bool, optional
+        measure the peak memory allocated during the extra (untimed) instrumented run with tracemalloc, by default True
+    verbose : bool, optional
+        print each result as it is measured, by default False
+    **kwargs
+        further arguments passed on to `maskfill` (e.g. `n_jobs`)
+
+    Returns
+    -------
+    List[dict]
+        one record per combination with the settings, 'masked_pixels', 'seconds' (best of `repeat`), 'seconds_all',
+        'iterations', the accuracy ('rms_error', the RMS difference from the unmasked synthetic image over the masked pixels,
+        and 'rms_vs_reference', the RMS difference from the iterative fill with size 3 and the same operator and smoothing)
+        and, if `memory` is set, 'peak_memory_mb'
+    """
+    image = synthetic_image(shape, seed=seed)
+    records = []
+    for mask_name in masks:
+        for coverage in coverages:
+            mask = MASKS[mask_name](shape, coverage=coverage, seed=seed)
+            references = {}
+            for size in sizes:
+                for operator in operators:
+                    for smoothing in smooth:
+                        for method in methods:
+                            settings = dict(size=size, operator=operator, smooth=smoothing, method=method, **kwargs)
+                            timings = []
+                            for _ in range(repeat):
+                                t0 = time.perf_counter()
+                                maskfill(image, mask, **settings)
+                                timings.append(time.perf_counter() - t0)
+                            stats = FillStats()
+                            if memory:
+                                tracemalloc.start()
+                            filled, _ = maskfill(image, mask, stats=stats, **settings)
+                            record = dict(shape=list(shape), mask=mask_name, coverage=coverage,
+                                          masked_pixels=int(mask.sum()), size=size, operator=operator,
+                                          smooth=smoothing, method=method, seconds=min(timings), seconds_all=timings,
+                                          iterations=len(stats.iterations))
+                            if memory:
+                                record['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+                                tracemalloc.stop()
+                            if (operator, smoothing) not in references:
+                                references[operator, smoothing] = maskfill(image, mask, operator=operator, smooth=smoothing, **kwargs)[0]
+                            record['rms_error'] = _rms(filled[mask] - image[mask])
+                            record['rms_vs_reference'] = _rms(filled[mask] - references[operator, smoothing][mask])
+                            if verbose:
+                                print(f"{mask_name:8s} coverage={coverage:<6g} size={size} {operator:6s} smooth={smoothing!s:5s} "
+                                      f"{method:9s} {record['seconds']:8.3f} s {record['iterations']:5d} it "
+                                      f"rms {record['rms_error']:.3g} (vs reference {record['rms_vs_reference']:.3g})" +
+                                      (f" {record['peak_memory_mb']:8.1f} MB" if memory else ''), file=sys.stderr)
+                            records.append(record)
+    return records
+
+
+# commands timed by `startup_times`, each run in a fresh interpreter
+STARTUP_COMMANDS = {'interpreter': 'pass',
+                    'import': 'import maskfill',
+                    'import_maskfill': 'from maskfill import maskfill',
+                    'cli_version': 'import sys; sys.argv[1:] = ["--version"]; from maskfill.command_line import maskfill_cli; maskfill_cli()',
+                    'cli_help': 'import sys; sys.argv[1:] = ["-h"]; from maskfill.command_line import maskfill_cli; maskfill_cli()'}
+
+
+def startup_times(repeat : int = 5, verbose : bool = False):
+    """Wall time of starting a Python interpreter that imports maskfill or runs its command line tool.
+
+    Parameters
+    ----------
+    repeat : int, optional
+        number of runs per command; the fastest is reported, by default 5
+    verbose : bool, optional
+        print each result as it is measured, by default False
+
+    Returns
+    -------
+    dict
+        best time in seconds for each of `STARTUP_COMMANDS`: 'interpreter' (the interpreter alone), 'import'
+        (the package), 'import_maskfill' (the fill function), 'cli_version' and 'cli_help' (`maskfill --version` and `-h`)
+    """
+    times = {}
+    for name, code in STARTUP_COMMANDS.items():
+        timings = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL, check=True)
+            timings.append(time.perf_counter() - t0)
+        times[name] = min(timings)
+        if verbose:
+            print(f"startup {name:16s} {times[name] * 1000:8.1f} ms", file=sys.stderr)
+    return times
+
+
+def environment():
+    """Versions and platform information stored with the benchmark results."""
+    import scipy
+    import astropy
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    return dict(maskfill=__version__, python=platform.python_version(), numpy=np.__version__,
+                scipy=scipy.__version__, astropy=astropy.__version__, numba=numba_version, platform=platform.platform(),
+                processor=platform.processor(), time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Benchmark maskfill on synthetic images and masks.")
+    parser.add_argument("--shape", help="image shape (default = 1024 1024)", type=int, nargs=2, default=[1024, 1024])
+    parser.add_argument("--masks", help=f"mask types (default = all of {', '.join(MASKS)})", nargs='+', choices=list(MASKS), default=list(MASKS))
+    parser.add_argument("--coverage", help="masked fractions (default = 0.001 0.01 0.1 0.5)", type=float, nargs='+', default=[0.001, 0.01, 0.1, 0.5])
+    parser.add_argument("--sizes", help="filter sizes (default = 3 5)", type=int, nargs='+', default=[3, 5])
+    parser.add_argument("--operators", help="operators (default = median mean)", nargs='+', choices=['median', 'mean'], default=['median', 'mean'])
+    parser.add_argument("--smooth", help="smoothing settings (default = on off)", nargs='+', choices=['on', 'off'], default=['on', 'off'])
+    parser.add_argument("--methods", help="fill methods (default = iterative)", nargs='+', choices=['iterative', 'pyramid', 'distance'], default=['iterative'])
+    parser.add_argument("--repeat", help="timed runs per combination (default = 3)", type=int, default=3)
+    parser.add_argument("--jobs", help="n_jobs passed to maskfill (default = 1)", type=int, default=1)
+    parser.add_argument("--backend", help="backend passed to maskfill (default = numpy)", choices=['numpy', 'numba', 'python'], default='numpy')
+    parser.add_argument("--seed", help="random seed (default = 0)", type=int, default=0)
+    parser.add_argument("--no-memory", help="skip the peak memory measurement", action="store_true")
+    parser.add_argument("--startup-only", help="only time the startup of the package and the command line tool", action="store_true")
+    parser.add_argument("--output", help="JSON file for the results (default = standard output)", type=str)
+    args = parser.parse_args()
+    startup = startup_times(repeat=max(args.repeat, 5), verbose=True)
+    if args.startup_only:
+        args.masks = []
+    records = run_benchmark(shape=tuple(args.shape),
+                            masks=args.masks,
+                            coverages=args.coverage,
+                            sizes=args.sizes,
+                            operators=args.operators,
+                            smooth=[s == 'on' for s in args.smooth],
+                            methods=args.methods,
+                            repeat=args.repeat,
+                            seed=args.seed,
+                            memory=not args.no_memory,
+                            verbose=True,
+                            n_jobs=args.jobs,
+                            backend=args.backend)
+    report = dict(environment=dict(environment(), backend=args.backend), startup=startup, results=records)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,129 @@
+"""On-disk cache of `maskfill` results, for reruns of reductions on unchanged frames.
+
+Each result is stored under a key that hashes the image data, the mask and the settings that change the
+output, as a directory with one .npy file per output image, so that a hit can be memory-mapped instead of
+read. The least recently used results are removed once the cache grows beyond its size limit.
+"""
+from typing import Union
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+
+
+class ResultCache:
+    """Directory of cached `maskfill` results, with a size limit and least-recently-used eviction.
+
+    Pass an instance (or just the directory) as the `cache` argument of `maskfill`, or use `--cache-dir` on the
+    command line. Results are found by content, so a frame is only filled again if its image, its mask or the
+    fill settings changed (or if the package version did). The cache can be shared by several threads and
+    processes.
+
+    Parameters
+    ----------
+    directory : str
+        cache directory; it is created if needed
+    max_bytes : int, optional
+        size limit of the cache, by default 2**30 (1 GiB). After a result is stored, the least recently used ones
+        are removed until the cache fits; a result larger than the limit is not stored at all.
+
+    Attributes
+    ----------
+    hits, misses : int
+        number of lookups that found a result, and that did not, since the instance was created
+    """
+    def __init__(self, directory:str, max_bytes:int = 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(image:np.ndarray, mask:np.ndarray, **settings):
+        """Hash of the image (values, dtype and shape), the boolean mask and the `settings` (JSON-serializable)."""
+        digest = hashlib.blake2b(digest_size=20)
+        image = np.ascontiguousarray(image)
+        digest.update(json.dumps([image.dtype.str, image.shape, mask.shape, settings], sort_keys=True).encode())
+        digest.update(image.data)
+        digest.update(np.packbits(mask).data)
+        return digest.hexdigest()
+
+    def get(self, key:str):
+        """The stored (output1, output2) for `key`, memory-mapped read-only, or None (counted as a miss)."""
+        entry = os.path.join(self.directory, key)
+        try:
+            outputs = [np.load(os.path.join(entry, f'{i}.npy'), mmap_mode='r') if os.path.exists(os.path.join(entry, f'{i}.npy'))
+                       else None for i in range(2)]
+            if outputs[0] is None:
+                raise FileNotFoundError(entry)
+            # the modification time of an entry is the time it was last used
+            os.utime(entry)
+        except (FileNotFoundError, ValueError):
+            # missing, being evicted by another process, or corrupt
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return tuple(outputs)
+
+    def put(self, key:str, result:tuple):
+        """Store the (output1, output2) `result` of `maskfill` under `key` (output2 may be None), then evict as needed."""
+        nbytes = sum(output.nbytes for output in result if output is not None)
+        if nbytes > self.max_bytes:
+            return
+        # written to a temporary directory and renamed into place, so an entry is either complete or absent
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.directory)
+        try:
+            for i, output in enumerate(result):
+                if output is not None:
+                    np.save(os.path.join(staging, f'{i}.npy'), output)
+            os.rename(staging, os.path.join(self.directory, key))
+        except OSError:
+            # e.g. stored meanwhile by another thread or process
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def _entries(self):
+        """(last use, size in bytes, path) of every complete entry."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.'):
+                continue
+            try:
+                entries.append((os.stat(path).st_mtime, sum(os.stat(os.path.join(path, f)).st_size for f in os.listdir(path)), path))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return entries
+
+    def evict(self, max_bytes:int = None):
+        """Remove the least recently used entries until the cache holds at most `max_bytes` (by default `self.max_bytes`)."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+    @property
+    def nbytes(self):
+        """Total size of the stored results, in bytes."""
+        return sum(size for _, size, _ in self._entries())
+
+    def to_dict(self):
+        """Hit and miss counts, and the size of the cache."""
+        return dict(directory=self.directory, hits=self.hits, misses=self.misses, nbytes=self.nbytes, max_bytes=self.max_bytes)
+
+
+def _as_cache(cache:Union[str,ResultCache]):
+    """`cache` as a ResultCache: a directory name gets one with the default size limit."""
+    return ResultCache(cache) if isinstance(cache, str) else cache
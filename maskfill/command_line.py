@@ -0,0 +1,131 @@
+"""The `maskfill` and `maskfill-batch` command line tools.
+
+The argument parsers only need the standard library: the fill modules (and with them numpy, and astropy for
+the fits files) are imported once the arguments are parsed, so that `-h` and `--version` return at once.
+"""
+import os
+import json
+import argparse
+from . import __version__
+
+
+def _parse_extension(value:str):
+    """Parse the --extension option: a single number, a comma-separated list of numbers, or 'all'."""
+    if value == 'all':
+        return value
+    if ',' in value:
+        return [int(e) for e in value.split(',') if e]
+    return int(value)
+
+
+def _add_fill_arguments(parser:argparse.ArgumentParser):
+    """Add the fill options shared by the maskfill command line tools to `parser`."""
+    parser.add_argument("--version", action="version", version=f"%(prog)s {__version__}")
+    parser.add_argument("-e", "--extension",help="fits extension of data: a number, a comma-separated list, or 'all'",type=_parse_extension)
+    parser.add_argument("-v", "--verbose", help="print actions", action="store_true")
+    parser.add_argument("-s", "--size", help="scale of median filter (default = 3)", type=int)
+    parser.add_argument("-o", "--operator", help="replace pixels with mean or median (default = median)", type=str)
+    parser.add_argument("-n", "--nosmooth", help="omit boxcar smoothing at the end (default = False)", action="store_true")
+    parser.add_argument("-t", "--dtype", help="data type of the output image, e.g. float32 (default = float32 or float64, depending on the input)", type=str)
+    parser.add_argument("--method", help="fill method: iterative, pyramid (coarse to fine, faster for large masks) or distance "
+                        "(in order of Euclidean distance to unmasked pixels) (default = iterative)", type=str,
+                        choices=['iterative', 'pyramid', 'distance'], default='iterative')
+    parser.add_argument("--backend", help="engine evaluating the operator: numpy, numba (compiled kernels, needs Numba; fastest for the median) or python (default = numpy)",
+                        type=str, choices=['numpy', 'numba', 'python'], default='numpy')
+    parser.add_argument("--low-memory", help="fill the memory-mapped input in place and stream the output, keeping memory use near the image size", action="store_true")
+    parser.add_argument("--strip-rows", help="read, fill and write the image in strips of this many rows, for images larger than memory", type=int)
+    parser.add_argument("--cache-dir", help="directory of a cache of results, reused when the same image and mask are filled again with the same settings", type=str)
+    parser.add_argument("--cache-size", help="size limit of the cache in GB; the least recently used results are removed beyond it (default = 1)", type=float, default=1.0)
+    parser.add_argument("--max-iterations", help="stop filling each masked region after this many iterations, leaving the rest NaN", type=int)
+    parser.add_argument("--max-distance", help="only fill pixels within this distance (in pixels) of valid data, leaving the rest NaN", type=float)
+    parser.add_argument("--keep-nans", help="only fill the masked pixels, keeping the NaNs of the input image", action="store_true")
+
+
+def _fill_options(args:argparse.Namespace):
+    """Translate the shared command line options into `maskfill` keyword arguments."""
+    from .cache import ResultCache
+    return dict(ext = args.extension if args.extension else 0,
+                size = args.size if args.size and args.size>2 else 3,
+                operator = args.operator if args.operator and args.operator in ['mean','median'] else 'median',
+                smooth = not args.nosmooth,
+                verbose = args.verbose if args.verbose else False,
+                low_memory = args.low_memory,
+                dtype = args.dtype,
+                method = args.method,
+                backend = args.backend,
+                strip_rows = args.strip_rows,
+                cache = ResultCache(args.cache_dir, max_bytes=int(args.cache_size * 2**30)) if args.cache_dir else None,
+                max_iterations = args.max_iterations,
+                max_distance = args.max_distance,
+                fill_nans = not args.keep_nans)
+
+
+def maskfill_cli():
+    parser = argparse.ArgumentParser(prog='maskfill')
+    # Define command line arguments
+    parser.add_argument("input", help="input image", type=str)
+    parser.add_argument("mask", help="mask image, with values 0 = good, 1 = bad", type=str)
+    parser.add_argument("output", help="output image", type=str)
+    _add_fill_arguments(parser)
+    parser.add_argument("-w", "--writesteps", help="write result after each iteration, as _iter_#.fits", action="store_true")
+    parser.add_argument("--steps-file", help="write the pixels filled in each iteration (iteration, row, column, value) to this fits table, instead of full images", type=str)
+    parser.add_argument("-j", "--jobs", help="number of threads for filling separate masked regions (default = 1, -1 = all cores)", type=int)
+    parser.add_argument("--profile", help="write a JSON report of the time spent per phase and per iteration to this file", type=str)
+    args = parser.parse_args()
+    from .maskfill import maskfill, FillStats, _cache_summary, _unfilled_summary
+    writesteps = args.steps_file if args.steps_file else (args.writesteps if args.writesteps else False)
+    output_file = args.output
+    n_jobs = args.jobs if args.jobs else 1
+    options = _fill_options(args)
+    limited = options['max_iterations'] is not None or options['max_distance'] is not None or not options['fill_nans']
+    # also collected to report the pixels that a limited fill leaves unfilled
+    stats = FillStats() if args.profile or limited else None
+    result1, result2 = maskfill(input_image=args.input,
+                                mask = args.mask,
+                                writesteps=writesteps,
+                                output_file=output_file,
+                                n_jobs = n_jobs,
+                                stats = stats,
+                                keep_unsmoothed = False,
+                                **options)
+    if options['cache'] is not None:
+        print(_cache_summary(options['cache']))
+    if limited and _unfilled_summary(stats) is not None:
+        print(_unfilled_summary(stats))
+    if args.profile:
+        stats.info.update(input=args.input, mask=args.mask, output=output_file)
+        stats.write(args.profile)
+
+
+def batch_cli():
+    parser = argparse.ArgumentParser(prog='maskfill-batch', description="Fill masks in many images in one invocation.")
+    parser.add_argument("inputs", help="glob pattern(s) of input images", type=str, nargs='*')
+    parser.add_argument("-m", "--manifest", help="text file with one 'input mask output' triple per line", type=str)
+    parser.add_argument("--input-dir", help="directory with input images", type=str)
+    parser.add_argument("--pattern", help="glob pattern of the images in --input-dir (default = *.fits)", type=str, default='*.fits')
+    parser.add_argument("--mask", help="mask image shared by all inputs, with values 0 = good, 1 = bad", type=str)
+    parser.add_argument("--mask-dir", help="directory with a mask per input, with the same file name", type=str)
+    parser.add_argument("--output-dir", help="directory for the outputs, with the same file names as the inputs", type=str)
+    _add_fill_arguments(parser)
+    parser.add_argument("-j", "--jobs", help="number of frames processed in parallel (default = 1, -1 = all cores)", type=int)
+    parser.add_argument("--profile", help="write a JSON report with the timings of every frame, per phase and per iteration, to this file", type=str)
+    parser.add_argument("-q", "--queue-depth", help="read the next frames and write the finished ones in background threads while filling, "
+                        "with up to this many frames waiting (default = 0, no pipeline)", type=int, default=0)
+    args = parser.parse_args()
+    from .batch import find_batch_jobs, run_batch
+    jobs = find_batch_jobs(manifest=args.manifest,
+                           inputs=args.inputs,
+                           input_dir=args.input_dir,
+                           pattern=args.pattern,
+                           mask=args.mask,
+                           mask_dir=args.mask_dir,
+                           output_dir=args.output_dir)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    records = run_batch(jobs, n_jobs=args.jobs if args.jobs else 1, profile=args.profile is not None, queue_depth=args.queue_depth,
+                        **_fill_options(args))
+    if args.profile is not None:
+        with open(args.profile, 'w') as f:
+            json.dump(records, f, indent=1)
+    if any(record['error'] is not None for record in records):
+        raise SystemExit(1)
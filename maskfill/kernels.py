@@ -0,0 +1,187 @@
+"""Per-pixel window kernels for the 'numba' backend of `maskfill`.
+
+The kernels are plain Python over the image, written so that Numba can compile them; `compiled_kernels`
+returns the compiled versions, or None if Numba is not installed. Uncompiled, they give the same
+results (only very slowly), which is what the tests without Numba check.
+
+Like the numpy engine, they reproduce np.nanmean and np.nanmedian of each window bit for bit: the
+mean sums the window with NaNs replaced by zero in numpy's pairwise summation order, and the median
+averages the two central values in the input dtype.
+"""
+import threading
+import numpy as np
+
+
+def _block_sum(values:np.ndarray, start:int, n:int, zero):
+    """Sum of values[start:start + n], n <= 128, in the order numpy sums such a block (see `_pairwise_sum`)."""
+    if n < 8:
+        total = zero
+        for i in range(start, start + n):
+            total += values[i]
+        return total
+    # eight interleaved partial sums, combined pairwise, then the remainder
+    r0, r1, r2, r3 = values[start], values[start + 1], values[start + 2], values[start + 3]
+    r4, r5, r6, r7 = values[start + 4], values[start + 5], values[start + 6], values[start + 7]
+    blocked = n - n % 8
+    for i in range(start + 8, start + blocked, 8):
+        r0 += values[i]
+        r1 += values[i + 1]
+        r2 += values[i + 2]
+        r3 += values[i + 3]
+        r4 += values[i + 4]
+        r5 += values[i + 5]
+        r6 += values[i + 6]
+        r7 += values[i + 7]
+    total = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+    for i in range(start + blocked, start + n):
+        total += values[i]
+    return total
+
+
+def _pairwise_sum(values:np.ndarray, n:int, zero):
+    """Sum of values[:n] in the order of numpy's pairwise summation (np.sum along a contiguous axis)."""
+    if n <= 128:
+        return _block_sum(values, 0, n, zero)
+    # numpy splits a range in two halves (at a multiple of 8) until the blocks hold at most 128 values,
+    # and adds the sums of the halves on the way back. The same, with an explicit stack of the ranges
+    # being split rather than recursion (which Numba compiles slowly and fails to cache).
+    starts = np.empty(64, dtype=np.int64)
+    sizes = np.empty(64, dtype=np.int64)
+    left_sums = np.empty(64, dtype=values.dtype)
+    left_done = np.empty(64, dtype=np.bool_)
+    depth = 0
+    start = 0
+    size = n
+    while True:
+        while size > 128:
+            starts[depth] = start
+            sizes[depth] = size
+            left_done[depth] = False
+            depth += 1
+            size = size // 2 - (size // 2) % 8
+        total = _block_sum(values, start, size, zero)
+        # a finished right half completes its parent range
+        while depth > 0 and left_done[depth - 1]:
+            depth -= 1
+            total = left_sums[depth] + total
+        if depth == 0:
+            return total
+        # a finished left half: continue with the right half of the same range
+        left_sums[depth - 1] = total
+        left_done[depth - 1] = True
+        half = sizes[depth - 1] // 2 - (sizes[depth - 1] // 2) % 8
+        start = starts[depth - 1] + half
+        size = sizes[depth - 1] - half
+
+
+def _load_window(arr:np.ndarray, row:int, col:int, pad_width:int, plane_height:int, window:np.ndarray):
+    """Copy the window of +/- pad_width around (row, col) into `window`, row-major, with NaN outside the
+    array or outside the plane of `plane_height` rows that holds `row` (see `maskfill._plane_rows`)."""
+    width = arr.shape[1]
+    local = row % plane_height
+    k = 0
+    for y in range(local - pad_width, local + pad_width + 1):
+        for x in range(col - pad_width, col + pad_width + 1):
+            if 0 <= y < plane_height and 0 <= x < width:
+                window[k] = arr[row - local + y, x]
+            else:
+                window[k] = np.nan
+            k += 1
+
+
+def _select(values:np.ndarray, n:int, k:int):
+    """Partially order values[:n] in place so that values[k] is the k-th smallest, with no larger value before it."""
+    left, right = 0, n - 1
+    while right > left:
+        # median-of-three pivot, moved to values[right]
+        middle = (left + right) // 2
+        if values[middle] < values[left]:
+            values[middle], values[left] = values[left], values[middle]
+        if values[right] < values[left]:
+            values[right], values[left] = values[left], values[right]
+        if values[middle] < values[right]:
+            values[middle], values[right] = values[right], values[middle]
+        pivot = values[right]
+        store = left
+        for i in range(left, right):
+            # swap unconditionally: the comparisons are unpredictable, so a branch costs more than the swap
+            value = values[i]
+            values[i] = values[store]
+            values[store] = value
+            store += value < pivot
+        values[store], values[right] = values[right], values[store]
+        if store == k:
+            return
+        if store < k:
+            left = store + 1
+        else:
+            right = store - 1
+
+
+def nanmean_kernel(arr:np.ndarray, rows:np.ndarray, cols:np.ndarray, pad_width:int, plane_height:int, out:np.ndarray):
+    """Write the np.nanmean of the window around each (rows[i], cols[i]) of `arr` to out[i]."""
+    window = np.empty((2 * pad_width + 1)**2, dtype=arr.dtype)
+    zero = window[:0].sum()
+    for i in range(rows.size):
+        _load_window(arr, rows[i], cols[i], pad_width, plane_height, window)
+        n = 0
+        for k in range(window.size):
+            if np.isnan(window[k]):
+                window[k] = 0
+            else:
+                n += 1
+        if n == 0:
+            out[i] = np.nan
+        else:
+            # np.nanmean divides the sum by an integer count, in float64
+            out[i] = np.float64(_pairwise_sum(window, window.size, zero)) / np.float64(n)
+
+
+def nanmedian_kernel(arr:np.ndarray, rows:np.ndarray, cols:np.ndarray, pad_width:int, plane_height:int, out:np.ndarray):
+    """Write the np.nanmedian of the window around each (rows[i], cols[i]) of `arr` to out[i]."""
+    window = np.empty((2 * pad_width + 1)**2, dtype=arr.dtype)
+    for i in range(rows.size):
+        _load_window(arr, rows[i], cols[i], pad_width, plane_height, window)
+        n = 0
+        for k in range(window.size):
+            if not np.isnan(window[k]):
+                window[n] = window[k]
+                n += 1
+        if n == 0:
+            out[i] = np.nan
+            continue
+        half = n // 2
+        _select(window, n, half)
+        if n % 2 == 1:
+            out[i] = window[half]
+        else:
+            low = window[0]
+            for k in range(1, half):
+                low = max(low, window[k])
+            out[i] = (low + window[half]) * 0.5
+
+
+_KERNELS = ['_block_sum', '_pairwise_sum', '_load_window', '_select', 'nanmean_kernel', 'nanmedian_kernel']
+_compiled = None
+_compile_lock = threading.Lock()
+
+
+def compiled_kernels():
+    """Numba-compiled {'nanmean': kernel, 'nanmedian': kernel}, or None if Numba is not installed.
+
+    Compilation happens on the first call of each kernel (and is cached on disk by Numba). The kernels
+    release the GIL, so threads (`n_jobs`) run them in parallel.
+    """
+    global _compiled
+    with _compile_lock:
+        if _compiled is None:
+            try:
+                import numba
+            except ImportError:
+                return None
+            # the kernels call each other through the module globals, so every one of them is compiled
+            namespace = globals()
+            jitted = {name: numba.njit(nogil=True, cache=True)(namespace[name]) for name in _KERNELS}
+            namespace.update(jitted)
+            _compiled = dict(nanmean=jitted['nanmean_kernel'], nanmedian=jitted['nanmedian_kernel'])
+        return _compiled
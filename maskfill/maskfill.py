@@ -1,8 +1,18 @@
-from typing import Union, Callable 
+from typing import Union, Callable, TYPE_CHECKING
 import numpy as np 
-from astropy.io import fits 
-import argparse 
-from scipy.signal import convolve2d
+import os
+import json
+import time
+import tempfile
+import threading
+import warnings
+from contextlib import contextmanager, nullcontext, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from .kernels import compiled_kernels
+from .cache import ResultCache, _as_cache
+from . import __version__
+if TYPE_CHECKING:
+    from astropy.io import fits
 
 
 def find_nan_indices(arr:np.ndarray,window_size:int=3):
@@ -23,16 +33,174 @@ def find_nan_indices(arr:np.ndarray,window_size:int=3):
     if window_size % 2 == 0:
         raise ValueError("Window_size must be odd")
     nan_mask = np.isnan(arr)
-    # Define the convolution kernel to count non-NaN neighbors
-    kernel = np.ones((window_size, window_size), dtype=int)
-    kernel[window_size // 2, window_size // 2] = 0  # Ignore the center pixel
-    # Count the non-NaN neighbors for each element
-    non_nan_neighbors = convolve2d(~nan_mask, kernel, mode='same', boundary='fill', fillvalue=0)
-    # Find indices where the element is NaN and has at least one non-NaN neighbor
-    result_indices = np.argwhere(nan_mask & (non_nan_neighbors > 0))
+    nan_rows = np.flatnonzero(nan_mask.any(axis=1))
+    if nan_rows.size == 0:
+        return np.empty((0, arr.ndim), dtype=np.intp)
+    nan_cols = np.flatnonzero(nan_mask.any(axis=0))
+    # only the bounding box of the NaNs, plus half a window, holds pixels that a NaN can see
+    half = window_size // 2
+    box = (slice(max(nan_rows[0] - half, 0), min(nan_rows[-1] + half + 1, arr.shape[0])),
+           slice(max(nan_cols[0] - half, 0), min(nan_cols[-1] + half + 1, arr.shape[1])))
+    # a pixel has a non-NaN neighbor where the maximum of the non-NaN mask over its window is 1; the center
+    # pixel itself is NaN for the pixels of interest, so it need not be excluded. The window maximum is
+    # separable: a maximum along the rows, then one along the columns of the result, in the same buffer.
+    from scipy.ndimage import maximum_filter1d
+    near_valid = maximum_filter1d((~nan_mask[box]).view(np.uint8), window_size, axis=1, mode='constant', cval=0)
+    maximum_filter1d(near_valid, window_size, axis=0, output=near_valid, mode='constant', cval=0)
+    # argwhere lists the pixels in row-major order
+    result_indices = np.argwhere(nan_mask[box] & near_valid.view(bool))
+    result_indices += [box[0].start, box[1].start]
     return result_indices
 
 
+def _plane_rows(height:int, rows:np.ndarray, plane_height:int = None):
+    """Rows within their plane, and the plane height, for an image of planes of `plane_height` rows stacked
+    on top of each other (a cube reshaped to 2D); a plain image (plane_height None) is a single plane."""
+    if plane_height is None or plane_height == height:
+        return rows, height
+    return rows % plane_height, plane_height
+
+
+def _window_indices(shape:tuple, rows:np.ndarray, cols:np.ndarray, pad_width:int, plane_height:int = None):
+    """Flat indices of the window of +/- pad_width around each (row, col), one row per pixel.
+
+    Returns `(indices, edge, outside)`: `edge` selects the windows within pad_width of the border,
+    and `outside` flags, for those windows, the positions that fall outside the array (or outside their
+    plane, see `_plane_rows`). Their indices are only valid after clipping to the array (as np.take does
+    with mode='clip').
+    """
+    width = shape[1]
+    local, height = _plane_rows(shape[0], rows, plane_height)
+    offsets = np.arange(-pad_width, pad_width + 1)
+    dy = np.repeat(offsets, offsets.size)
+    dx = np.tile(offsets, offsets.size)
+    indices = (rows * width + cols)[:, None] + (dy * width + dx)
+    edge = np.flatnonzero((local < pad_width) | (local >= height - pad_width) |
+                          (cols < pad_width) | (cols >= width - pad_width))
+    yy = local[edge, None] + dy
+    xx = cols[edge, None] + dx
+    outside = (yy < 0) | (yy >= height) | (xx < 0) | (xx >= width)
+    return indices, edge, outside
+
+
+def _take_windows(arr:np.ndarray, indices:np.ndarray, edge:np.ndarray, outside:np.ndarray):
+    """Gather the windows described by `_window_indices` from `arr`, with NaN outside the array."""
+    windows = np.take(arr, indices, mode='clip')
+    # only windows within pad_width of the border need their outside positions blanked
+    if edge.size:
+        windows[edge] = np.where(outside, np.nan, windows[edge])
+    return windows
+
+
+def _gather_windows(arr:np.ndarray, rows:np.ndarray, cols:np.ndarray, pad_width:int, plane_height:int = None):
+    """Stack the window of +/- pad_width around each (row, col) into one row per pixel.
+
+    Windows are flattened in row-major order (the same order as slicing a padded image),
+    and positions falling outside the array (or plane) are NaN, as with the NaN padding used by
+    `process_masked_pixels`.
+    """
+    return _take_windows(arr, *_window_indices(arr.shape, rows, cols, pad_width, plane_height))
+
+
+def _nanmean_windows(windows:np.ndarray):
+    """NaN-ignoring mean of each row of `windows`; bit-identical to calling np.nanmean per window."""
+    finite = ~np.isnan(windows)
+    # summing the zero-filled rows along the contiguous axis reproduces np.nansum's summation order
+    sums = np.where(finite, windows, 0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / finite.sum(axis=1)).astype(windows.dtype)
+
+
+def _nanmedian_windows(windows:np.ndarray):
+    """NaN-ignoring median of each row of `windows`; bit-identical to calling np.nanmedian per window."""
+    n_finite = np.count_nonzero(~np.isnan(windows), axis=1)
+    # NaNs sort to the end of each row, so the finite values occupy the first n_finite slots
+    ordered = np.sort(windows, axis=1)
+    low = np.take_along_axis(ordered, ((n_finite - 1) // 2)[:, None], axis=1)[:, 0]
+    high = np.take_along_axis(ordered, (n_finite // 2)[:, None], axis=1)[:, 0]
+    # np.median averages the two central values in the input dtype for even counts
+    return np.where(n_finite % 2 == 1, low, (low + high) / 2).astype(windows.dtype)
+
+
+def _boxcar_mean_windows(windows:np.ndarray):
+    """`_nanmean_windows` for windows that are mostly complete, as in the smoothing pass after the fill."""
+    incomplete = np.isnan(windows).any(axis=1)
+    # a plain mean of the complete windows, with the same summation order and the same (int64)
+    # divisor type as np.nanmean; only the windows with NaNs (at the border) need the masked sum
+    means = windows.sum(axis=1) / np.int64(windows.shape[1])
+    if incomplete.any():
+        means[incomplete] = _nanmean_windows(windows[incomplete])
+    return means.astype(windows.dtype)
+
+
+# operator functions with an array-based implementation over stacked windows
+_WINDOW_OPERATORS = {np.nanmean: _nanmean_windows, np.nanmedian: _nanmedian_windows}
+# number of window values gathered at once; the pixels per chunk shrink with the window size,
+# so memory stays bounded for any `size`
+_CHUNK_ELEMENTS = 2**20
+
+
+def _apply_window_operator(arr:np.ndarray, rows:np.ndarray, cols:np.ndarray, pad_width:int, window_operator:Callable,
+                           plane_height:int = None):
+    """Evaluate `window_operator` on the windows around (rows, cols) of `arr`, in chunks.
+
+    Returns the new values for those pixels; `arr` itself is not modified, so the caller can
+    write all values at once after every window has been read.
+    """
+    values = np.empty(rows.size, dtype=arr.dtype)
+    chunk = max(1, _CHUNK_ELEMENTS // (2 * pad_width + 1)**2)
+    for start in range(0, rows.size, chunk):
+        stop = start + chunk
+        windows = _gather_windows(arr, rows[start:stop], cols[start:stop], pad_width, plane_height)
+        values[start:stop] = window_operator(windows)
+    return values
+
+
+def _numpy_engine(arr:np.ndarray, rows:np.ndarray, cols:np.ndarray, pad_width:int, operator_func:Callable,
+                  plane_height:int = None):
+    """New values of the pixels (rows, cols) of `arr`: `operator_func` evaluated on all their windows at once (see `_WINDOW_OPERATORS`)."""
+    return _apply_window_operator(arr, rows, cols, pad_width, _WINDOW_OPERATORS[operator_func], plane_height)
+
+
+def _python_engine(arr:np.ndarray, rows:np.ndarray, cols:np.ndarray, pad_width:int, operator_func:Callable,
+                   plane_height:int = None):
+    """As `_numpy_engine`, but calling `operator_func` on one window at a time, as the original implementation did."""
+    size = 2 * pad_width + 1
+    values = np.empty(rows.size, dtype=arr.dtype)
+    chunk = max(1, _CHUNK_ELEMENTS // size**2)
+    for start in range(0, rows.size, chunk):
+        stop = start + chunk
+        windows = _gather_windows(arr, rows[start:stop], cols[start:stop], pad_width, plane_height)
+        values[start:stop] = [operator_func(window.reshape(size, size)) for window in windows]
+    return values
+
+
+def _numba_engine(arr:np.ndarray, rows:np.ndarray, cols:np.ndarray, pad_width:int, operator_func:Callable,
+                  plane_height:int = None):
+    """As `_numpy_engine`, with the compiled per-pixel kernels of `maskfill.kernels`, which need no gathered windows."""
+    if arr.dtype not in (np.float32, np.float64) or not arr.dtype.isnative:
+        # e.g., a big-endian fits memory map passed as `out`; the kernels are compiled for native floats only
+        return _numpy_engine(arr, rows, cols, pad_width, operator_func, plane_height)
+    values = np.empty(rows.size, dtype=arr.dtype)
+    kernel = compiled_kernels()[operator_func.__name__]
+    kernel(arr, rows, cols, pad_width, arr.shape[0] if plane_height is None else plane_height, values)
+    return values
+
+
+# engines that evaluate the fill (and smoothing) operator, selected by the `backend` argument of `maskfill`
+_BACKENDS = {'python': _python_engine, 'numpy': _numpy_engine, 'numba': _numba_engine}
+
+
+def _resolve_backend(backend:str):
+    """Check `backend`, and replace 'numba' by 'numpy' (with a warning) if Numba is not installed."""
+    if backend not in _BACKENDS:
+        raise ValueError(f'Backend must be one of {", ".join(_BACKENDS)}.')
+    if backend == 'numba' and compiled_kernels() is None:
+        warnings.warn('Numba is not installed; using the numpy backend instead.', RuntimeWarning)
+        return 'numpy'
+    return backend
+
+
 def process_masked_pixels(input_image : np.ndarray,
                         pad_width : int, 
                         mask : np.ndarray = None, 
@@ -51,18 +219,25 @@ def process_masked_pixels(input_image : np.ndarray,
     operator_func : Callable, optional
         operation to apply to the masked or NaN pixels in the window of +/- padwidth, by default np.nanmean
         For maskfill to work, the operator function must compute statistics while ignoring NaN values in the input.
+        np.nanmean and np.nanmedian are evaluated on all windows at once; any other callable is applied pixel by pixel.
 
     Returns
     -------
     np.ndarray
         Image with all masked or NaN pixels that have neighboring non-NaN values replaced by the operator func applied to those neighbors.
     """
-    padded_output = np.pad(input_image, pad_width, 'constant', constant_values=np.nan)
     #if mask provided, index list generated from mask. Else, index list is any NaN in input image.
     if mask is not None:
         ind_masked = np.column_stack(np.where(mask)) 
     else:
         ind_masked = find_nan_indices(input_image)
+    window_operator = _WINDOW_OPERATORS.get(operator_func)
+    if window_operator is not None:
+        # all windows are read before any pixel is written, exactly as with the padded copy below
+        rows, cols = ind_masked[:, 0], ind_masked[:, 1]
+        input_image[rows, cols] = _apply_window_operator(input_image, rows, cols, pad_width, window_operator)
+        return input_image
+    padded_output = np.pad(input_image, pad_width, 'constant', constant_values=np.nan)
     for i in ind_masked:
         y = i[0] 
         x =i[1]
@@ -72,39 +247,621 @@ def process_masked_pixels(input_image : np.ndarray,
         input_image[y, x] = operator_func(local_window)
     return input_image
 
+# offsets of the eight neighbors that define the frontier (the 3x3 window of `find_nan_indices`)
+_NEIGHBOR_OFFSETS = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dy, dx) != (0, 0)]
+
+
+def _neighbors(shape:tuple, rows:np.ndarray, cols:np.ndarray, plane_height:int = None):
+    """Yield, for each of the eight neighbor offsets, the in-bounds (and in-plane, see `_plane_rows`)
+    neighbor coordinates of (rows, cols) together with the boolean selection of pixels that have such a neighbor."""
+    width = shape[1]
+    local, height = _plane_rows(shape[0], rows, plane_height)
+    for dy, dx in _NEIGHBOR_OFFSETS:
+        y, x = local + dy, cols + dx
+        inside = (y >= 0) & (y < height) & (x >= 0) & (x < width)
+        yield rows[inside] + dy, x[inside], inside
+
+
+def _initial_frontier(nan_mask:np.ndarray, plane_height:int = None):
+    """Row-major (rows, cols) of the NaN pixels with at least one non-NaN neighbor.
+
+    Equivalent to `find_nan_indices` with a 3x3 window, but only the NaN pixels are examined.
+    """
+    rows, cols = np.nonzero(nan_mask)
+    on_frontier = _has_valid_neighbor(nan_mask, rows, cols, plane_height)
+    return rows[on_frontier], cols[on_frontier]
+
+
+def _has_valid_neighbor(nan_mask:np.ndarray, rows:np.ndarray, cols:np.ndarray, plane_height:int = None):
+    """Boolean selection of the pixels (rows, cols) with at least one non-NaN neighbor."""
+    found = np.zeros(rows.size, dtype=bool)
+    for y, x, inside in _neighbors(nan_mask.shape, rows, cols, plane_height):
+        found[inside] |= ~nan_mask[y, x]
+    return found
+
+
+def _next_frontier(nan_mask:np.ndarray, rows:np.ndarray, cols:np.ndarray, plane_height:int = None):
+    """Row-major (rows, cols) of the frontier after the pixels (rows, cols) have been filled.
+
+    A NaN pixel can only gain a non-NaN neighbor from the pixels just filled, so the new
+    frontier is found among their neighbors instead of by rescanning the image.
+    """
+    width = nan_mask.shape[1]
+    candidates = np.concatenate([y * width + x for y, x, _ in _neighbors(nan_mask.shape, rows, cols, plane_height)])
+    candidates = candidates[nan_mask.ravel()[candidates]]
+    # sort and drop duplicates (much faster than np.unique for these integer arrays)
+    candidates.sort()
+    candidates = candidates[np.concatenate(([True], candidates[1:] != candidates[:-1]))[:candidates.size]]
+    return candidates // width, candidates % width
+
+
+def _iterative_fill(output:np.ndarray, pad_width:int, operator_func:Callable, writesteps:bool = False, verbose:bool = False,
+                    stats:'FillStats' = None, label:str = '', plane_height:int = None, backend:str = 'numpy',
+                    fillable:np.ndarray = None, max_iterations:int = None, steps:list = None):
+    """Fill all NaNs in `output` in place, layer by layer, tracking the frontier between iterations.
+
+    Each iteration is identical to `process_masked_pixels(output, pad_width, operator_func=operator_func)`,
+    but costs scale with the number of frontier pixels rather than with the image area.
+    With `plane_height`, `output` is a stack of planes of that height (see `_plane_rows`), which are
+    filled together but independently of each other; a plane drops out once it is filled.
+    With `fillable`, only the NaNs it selects are filled; the others stay NaN (and, like every NaN, are not
+    used as data). With `max_iterations`, the fill stops after that many iterations (layers).
+    With `writesteps`, the image is written to `_iter_<iteration>.fits` after each iteration; the (rows, cols, values)
+    filled in each iteration are appended to the list `steps` (if given, see `_write_steps`).
+    The operator is evaluated by the `backend` engine (see `_BACKENDS`). Each iteration is recorded in `stats`
+    (if given) under `label`. Returns the number of iterations performed.
+    """
+    engine = _BACKENDS[backend]
+    t0 = time.perf_counter()
+    nan_mask = np.isnan(output)
+    remaining = np.count_nonzero(nan_mask if fillable is None else fillable)
+    rows, cols = _select_fillable(fillable, *_initial_frontier(nan_mask, plane_height))
+    find_seconds = time.perf_counter() - t0
+    counter = 0
+    while rows.size and (max_iterations is None or counter < max_iterations):
+        counter += 1
+        if verbose:
+            print(f'On iteration {counter} | Masked pixels remaining: {remaining}')
+        t0 = time.perf_counter()
+        output[rows, cols] = engine(output, rows, cols, pad_width, operator_func, plane_height)
+        t1 = time.perf_counter()
+        nan_mask[rows, cols] = False
+        if writesteps:
+            from astropy.io import fits
+            fits.writeto(f"_iter_{counter}.fits", output, overwrite=True)
+            if verbose:
+                print(f'Intermediate fits written to: {f"_iter_{counter}.fits"}.')
+        if steps is not None:
+            steps.append((rows, cols, output[rows, cols]))
+        t2 = time.perf_counter()
+        if stats is not None:
+            stats.add_iteration(dict(region=label, iteration=counter, frontier=int(rows.size), remaining=int(remaining),
+                                     find_seconds=find_seconds, fill_seconds=t1 - t0, io_seconds=t2 - t1))
+        remaining -= rows.size
+        rows, cols = _select_fillable(fillable, *_next_frontier(nan_mask, rows, cols, plane_height))
+        find_seconds = time.perf_counter() - t2
+    if remaining and verbose:
+        if rows.size:
+            print(f'{remaining} NaN pixels left unfilled after max_iterations={max_iterations}.')
+        else:
+            print(f'{remaining} NaN pixels have no non-NaN pixel to be filled from.')
+    return counter
+
+
+def _select_fillable(fillable:np.ndarray, rows:np.ndarray, cols:np.ndarray):
+    """The pixels (rows, cols) selected by `fillable`, or all of them if it is None."""
+    if fillable is None:
+        return rows, cols
+    keep = fillable[rows, cols]
+    return rows[keep], cols[keep]
+
+
+def _count_unfilled(stats:'FillStats', n:int, iterations:int, max_iterations:int = None):
+    """Count `n` pixels that a fill of `iterations` iterations left unfilled in `stats`, as 'unfilled_max_iterations' if
+    the fill was stopped by `max_iterations`, or else as 'unfilled_no_data' (no valid pixel to be filled from)."""
+    if n:
+        stopped = max_iterations is not None and iterations >= max_iterations
+        stats.add_count('unfilled_max_iterations' if stopped else 'unfilled_no_data', int(n))
+
+
+# the pyramid method fills the hole pixels within this many pixels of valid data at full resolution;
+# deeper hole pixels start from the fill of the next coarser level
+_PYRAMID_BAND = 4
+
+
+def _downsample(arr:np.ndarray):
+    """NaN-ignoring mean of the 2x2 blocks of `arr` (a block is NaN only if all its pixels are)."""
+    height, width = arr.shape
+    padded = np.full((height + height % 2, width + width % 2), np.nan, dtype=arr.dtype)
+    padded[:height, :width] = arr
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    finite = ~np.isnan(blocks)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (np.where(finite, blocks, 0).sum(axis=(1, 3)) / finite.sum(axis=(1, 3))).astype(arr.dtype)
+
+
+def _upsample_axis(arr:np.ndarray, axis:int):
+    """Linear 2x upsampling of `arr` along `axis`: fine pixel 2k is 3/4 of coarse pixel k plus 1/4 of k-1,
+    and 2k+1 is 3/4 of k plus 1/4 of k+1 (with the edges repeated)."""
+    arr = np.moveaxis(arr, axis, 0)
+    upsampled = np.empty((2 * arr.shape[0],) + arr.shape[1:], dtype=arr.dtype)
+    upsampled[0::2] = 0.75 * arr + 0.25 * np.concatenate([arr[:1], arr[:-1]])
+    upsampled[1::2] = 0.75 * arr + 0.25 * np.concatenate([arr[1:], arr[-1:]])
+    return np.moveaxis(upsampled, 0, axis)
+
+
+def _upsample_values(coarse:np.ndarray, rows:np.ndarray, cols:np.ndarray):
+    """Bilinear interpolation of the half-resolution `coarse` at the full-resolution pixels (rows, cols), ignoring NaNs."""
+    # only the coarse pixels around the bounding box of (rows, cols) are upsampled
+    y0, x0 = max(rows.min() // 2 - 1, 0), max(cols.min() // 2 - 1, 0)
+    y1, x1 = rows.max() // 2 + 2, cols.max() // 2 + 2
+    block = coarse[y0:y1, x0:x1]
+    finite = ~np.isnan(block)
+    values = _upsample_axis(_upsample_axis(np.where(finite, block, 0), 0), 1)
+    weights = _upsample_axis(_upsample_axis(finite.astype(block.dtype), 0), 1)
+    rows, cols = rows - 2 * y0, cols - 2 * x0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return values[rows, cols] / weights[rows, cols]
+
+
+def _longest_row_run(mask:np.ndarray):
+    """Length of the longest run of consecutive True values within a row of `mask`."""
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    # every run starts and ends within its own (zero-padded) row, so the changes pair up
+    changes = np.flatnonzero(np.diff(padded.ravel()))
+    return int((changes[1::2] - changes[0::2]).max()) if changes.size else 0
+
+
+def _pyramid_fill(output:np.ndarray, pad_width:int, operator_func:Callable, verbose:bool = False,
+                  stats:'FillStats' = None, label:str = '', level:int = 0, backend:str = 'numpy'):
+    """Fill all NaNs in `output` in place, coarse to fine.
+
+    The image is downsampled 2x2 and filled recursively; the hole pixels more than `_PYRAMID_BAND` pixels
+    from valid data then take the (bilinearly upsampled) coarse fill, and the remaining band along the
+    edges of the holes is filled with `_iterative_fill` at full resolution, from both sides. Every level
+    needs about `_PYRAMID_BAND` iterations, so the iterations grow with the log of the hole radius
+    rather than with the radius. Returns the total number of iterations performed.
+    """
+    holes = np.isnan(output)
+    window = 2 * _PYRAMID_BAND + 1
+    # a hole pixel can only be deeper than the band in a row of at least `window` hole pixels,
+    # which is much cheaper to rule out (e.g., for cosmic rays) than the dilation itself
+    if min(output.shape) >= 2 * _PYRAMID_BAND and _longest_row_run(holes) >= window:
+        from scipy.ndimage import binary_dilation
+        deep = holes & ~binary_dilation(~holes, structure=np.ones((window, window), dtype=bool))
+    else:
+        deep = None
+    if deep is None or not deep.any():
+        return _iterative_fill(output, pad_width, operator_func, verbose=verbose, stats=stats, label=f'{label} (level {level})',
+                               backend=backend)
+    if verbose:
+        print(f'Pyramid level {level} | {np.count_nonzero(deep)} pixels from level {level + 1}')
+    coarse = _downsample(output)
+    counter = _pyramid_fill(coarse, pad_width, operator_func, verbose=verbose, stats=stats, label=label, level=level + 1,
+                            backend=backend)
+    rows, cols = np.nonzero(deep)
+    output[rows, cols] = _upsample_values(coarse, rows, cols)
+    return counter + _iterative_fill(output, pad_width, operator_func, verbose=verbose, stats=stats, label=f'{label} (level {level})',
+                                     backend=backend)
+
+
+def _squared_distances(holes:np.ndarray, rows:np.ndarray, cols:np.ndarray):
+    """Squared Euclidean distance of the hole pixels (rows, cols), in row-major order, to the nearest pixel outside `holes`.
+
+    The same as distance_transform_edt(holes)**2 at those pixels, but computed for the holes only: first the
+    distance to the nearest non-hole pixel in the same row, from the runs of holes in each row, then, column-wise,
+    the nearest of those over ever more distant rows, until no closer pixel can be found. The cost grows with the
+    number of hole pixels times their distance, rather than with the image area.
+    """
+    height, width = holes.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = holes
+    # as in `_longest_row_run`; the pixels (rows, cols) fill the runs one after the other
+    changes = np.flatnonzero(np.diff(padded.ravel()))
+    starts, stops = changes[0::2], changes[1::2]
+    run = np.repeat(np.arange(starts.size), stops - starts)
+    first, last = starts[run] % (width + 2), stops[run] % (width + 2) - 1
+    # larger than any distance within the image: a row without pixels outside the holes
+    beyond = height + width
+    left = np.where(first > 0, cols - first + 1, beyond)
+    right = np.where(last < width - 1, last - cols + 1, beyond)
+    row_distance = np.zeros(holes.shape, dtype=np.int64)
+    row_distance[rows, cols] = np.minimum(left, right)
+    best = row_distance[rows, cols]**2
+    pending = np.flatnonzero(best > 1)
+    offset = 1
+    while pending.size:
+        y, x = rows[pending], cols[pending]
+        for neighbor in (y - offset, y + offset):
+            inside = (neighbor >= 0) & (neighbor < height)
+            candidates = offset**2 + row_distance[neighbor[inside], x[inside]]**2
+            best[pending[inside]] = np.minimum(best[pending[inside]], candidates)
+        offset += 1
+        # a row further away can only be closer if the offset alone is smaller than the best distance
+        pending = pending[best[pending] > offset**2]
+    return best
+
+
+def _distance_fill(output:np.ndarray, pad_width:int, operator_func:Callable, verbose:bool = False,
+                   stats:'FillStats' = None, label:str = '', backend:str = 'numpy', fillable:np.ndarray = None,
+                   max_iterations:int = None):
+    """Fill all NaNs in `output` in place, in order of their Euclidean distance to the nearest non-NaN pixel.
+
+    A single distance transform orders the NaN pixels, which are then filled in one sweep, shell by shell:
+    shell k holds the pixels at a distance in (k - 1, k] and is filled from the pixels of the shells before it.
+    A pixel whose window holds none of those waits for the rest of its shell; one of its neighbors is always
+    closer to the valid data, so the shell is done after a pass or two. Unlike `_iterative_fill`, no frontier
+    is searched for between iterations, and the fill advances in circles rather than squares around the valid
+    data. `fillable` and `max_iterations` (passes) limit the fill as in `_iterative_fill`; a pixel whose closer
+    neighbors are NaNs that are not filled waits for the later shells. Each pass is recorded in `stats` (if given)
+    under `label`. Returns the number of passes performed.
+    """
+    engine = _BACKENDS[backend]
+    t0 = time.perf_counter()
+    nan_mask = np.isnan(output)
+    if nan_mask.all():
+        if verbose:
+            print(f'{nan_mask.size} NaN pixels have no non-NaN pixel to be filled from.')
+        return 0
+    rows, cols = np.nonzero(nan_mask)
+    shells = np.ceil(np.sqrt(_squared_distances(nan_mask, rows, cols))).astype(np.int64)
+    if fillable is not None:
+        keep = fillable[rows, cols]
+        rows, cols, shells = rows[keep], cols[keep], shells[keep]
+    # row-major order within each shell, as in the frontiers of the iterative fill
+    order = np.argsort(shells, kind='stable')
+    bounds = np.flatnonzero(np.diff(shells[order])) + 1
+    remaining = rows.size
+    find_seconds = time.perf_counter() - t0
+    counter = 0
+    waiting_rows, waiting_cols = rows[:0], cols[:0]
+    # a last, empty shell for the pixels still waiting after all shells
+    for shell_rows, shell_cols in zip(np.split(rows[order], bounds) + [rows[:0]], np.split(cols[order], bounds) + [cols[:0]]):
+        shell_rows, shell_cols = np.concatenate([waiting_rows, shell_rows]), np.concatenate([waiting_cols, shell_cols])
+        while shell_rows.size:
+            if counter == max_iterations:
+                if verbose:
+                    print(f'{remaining} NaN pixels left unfilled after max_iterations={max_iterations}.')
+                return counter
+            t0 = time.perf_counter()
+            ready = _has_valid_neighbor(nan_mask, shell_rows, shell_cols)
+            if not ready.any():
+                break
+            counter += 1
+            if verbose:
+                print(f'On iteration {counter} | Masked pixels remaining: {remaining}')
+            fill_rows, fill_cols = shell_rows[ready], shell_cols[ready]
+            shell_rows, shell_cols = shell_rows[~ready], shell_cols[~ready]
+            t1 = time.perf_counter()
+            output[fill_rows, fill_cols] = engine(output, fill_rows, fill_cols, pad_width, operator_func)
+            nan_mask[fill_rows, fill_cols] = False
+            if stats is not None:
+                stats.add_iteration(dict(region=label, iteration=counter, frontier=int(fill_rows.size), remaining=int(remaining),
+                                         find_seconds=find_seconds + t1 - t0, fill_seconds=time.perf_counter() - t1, io_seconds=0.0))
+            remaining -= fill_rows.size
+            find_seconds = 0.0
+        waiting_rows, waiting_cols = shell_rows, shell_cols
+    if remaining and verbose:
+        print(f'{remaining} NaN pixels have no non-NaN pixel to be filled from.')
+    return counter
+
+
+# fill engines selected by the `method` argument of `maskfill`
+_FILL_METHODS = {'iterative': _iterative_fill, 'pyramid': _pyramid_fill, 'distance': _distance_fill}
+
+
+def _split_runs(indices:np.ndarray, gap:int):
+    """Split sorted `indices` into (first, last) runs wherever consecutive entries differ by more than `gap`."""
+    breaks = np.flatnonzero(np.diff(indices) > gap)
+    return zip(indices[np.concatenate(([0], breaks + 1))], indices[np.concatenate((breaks, [indices.size - 1]))])
+
+
+# boxes smaller than this (in pixels) are filled as a whole rather than split further: below it, the fixed
+# cost of filling one more region outweighs the cost of scanning the hole-free parts of the box
+_MIN_SPLIT_AREA = 2**17
+
+
+def _hole_regions(holes:np.ndarray, pad_width:int):
+    """Split the holes into boxes that can be filled independently of each other.
+
+    The hole mask is cut recursively along rows or columns that are free of holes over more than
+    `pad_width` pixels, so no fill window of one box can see a hole of another. Each box is
+    returned as a (row slice, column slice) pair that covers its holes plus a margin of `pad_width`,
+    which is all the image data the fill of those holes depends on.
+    """
+    height, width = holes.shape
+    regions = []
+    pending = [(0, height, 0, width)]
+    while pending:
+        y0, y1, x0, x1 = pending.pop()
+        sub = holes[y0:y1, x0:x1]
+        rows = np.flatnonzero(sub.any(axis=1))
+        if rows.size == 0:
+            continue
+        cols = np.flatnonzero(sub.any(axis=0))
+        if sub.size <= _MIN_SPLIT_AREA:
+            row_runs = col_runs = [None]
+        else:
+            row_runs = list(_split_runs(rows, pad_width))
+            col_runs = list(_split_runs(cols, pad_width))
+        if len(row_runs) > 1:
+            pending.extend((y0 + first, y0 + last + 1, x0, x1) for first, last in row_runs)
+        elif len(col_runs) > 1:
+            pending.extend((y0, y1, x0 + first, x0 + last + 1) for first, last in col_runs)
+        else:
+            regions.append((slice(max(y0 + rows[0] - pad_width, 0), min(y0 + rows[-1] + 1 + pad_width, height)),
+                            slice(max(x0 + cols[0] - pad_width, 0), min(x0 + cols[-1] + 1 + pad_width, width))))
+    return regions
+
+
+def _n_threads(n_jobs:int):
+    """Number of threads requested by `n_jobs`: a positive number, or -1 for all available cores."""
+    if n_jobs is None or n_jobs == 0 or n_jobs < -1:
+        raise ValueError("n_jobs must be a positive integer or -1 (all cores)")
+    if n_jobs == -1:
+        return os.cpu_count() or 1
+    return n_jobs
+
+
+def _map_jobs(func:Callable, items:list, n_jobs:int = 1):
+    """Return [func(item) for item in items], evaluated on a pool of `n_jobs` threads if n_jobs != 1.
+
+    n_jobs=-1 uses all available cores. Results are returned in the order of `items`.
+    """
+    n_jobs = _n_threads(n_jobs)
+    if n_jobs == 1 or len(items) < 2:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(n_jobs, len(items))) as pool:
+        return list(pool.map(func, items))
+
+
+def _fill_regions(output:np.ndarray, holes:np.ndarray, pad_width:int, operator_func:Callable, verbose:bool = False, n_jobs:int = 1,
+                  stats:'FillStats' = None, label:str = '', method:str = 'iterative', backend:str = 'numpy',
+                  only_holes:bool = False, max_iterations:int = None):
+    """Fill the `holes` of `output` in place, one independent region at a time.
+
+    Each region is cut out with its margin, filled with the `method` engine and pasted back, which
+    gives the same result as filling the whole image while only touching the masked areas.
+    Regions only write their own holes and never read those of another region, so they can be
+    filled concurrently on `n_jobs` threads with a result identical to the serial run.
+    With `only_holes`, the other NaNs of `output` are left as they are; `max_iterations` limits the fill of each
+    region. The holes left unfilled are counted in `stats` (see `_count_unfilled`).
+    """
+    regions = _hole_regions(holes, pad_width)
+    if verbose:
+        print(f'Filling {len(regions)} independent masked regions.')
+    if stats is not None:
+        stats.add_count('regions', len(regions))
+
+    def fill_region(region):
+        member = holes[region]
+        view = output[region]
+        # fill contiguous regions (e.g. full-width bands) directly, copy out the others
+        cutout = view if view.flags.c_contiguous else np.array(view)
+        cutout[member] = np.nan
+        if verbose:
+            print(f'Region | rows {region[0].start}-{region[0].stop - 1}, columns {region[1].start}-{region[1].stop - 1}')
+        region_label = f'{label}rows {region[0].start}-{region[0].stop - 1}, columns {region[1].start}-{region[1].stop - 1}'
+        limits = {}
+        if only_holes:
+            limits['fillable'] = member
+        if max_iterations is not None:
+            limits['max_iterations'] = max_iterations
+        iterations = _FILL_METHODS[method](cutout, pad_width, operator_func, verbose=verbose, stats=stats, label=region_label,
+                                           backend=backend, **limits)
+        if stats is not None:
+            _count_unfilled(stats, np.count_nonzero(np.isnan(cutout[member])), iterations, max_iterations)
+        if cutout is not view:
+            view[member] = cutout[member]
+
+    _map_jobs(fill_region, regions, n_jobs)
+
+
+class FillStats:
+    """Instrumentation of `maskfill` runs: where the time goes, phase by phase and iteration by iteration.
+
+    Pass an instance as the `stats` argument of `maskfill` (or use `--profile` on the command line).
+    It collects
+
+    - `timings`: the wall time of each phase, in seconds: 'read' (fits input), 'prepare' (copying the
+      input into the working buffer; this is where a memory-mapped input is actually read), 'fill',
+      'smooth', 'write' (fits output), 'cache' (hashing, and looking up and storing results) and 'total';
+    - `iterations`: one record per fill iteration, with the region (or plane/extension) it belongs to,
+      the iteration number, the frontier size, the masked pixels remaining before the iteration, and the
+      time spent finding the frontier ('find_seconds'), filling it ('fill_seconds') and writing
+      intermediate steps ('io_seconds');
+    - `counts` (e.g. the number of independent regions, of cache hits and misses, or of the pixels left unfilled,
+      see `unfilled`) and `info` (image shape, masked pixels, settings).
+
+    The same instance can be passed to several calls, whose timings and iterations then add up.
+
+    Parameters
+    ----------
+    callback : Callable, optional
+        function called with each iteration record (a dict) as soon as the iteration is done, by default None
+    """
+    def __init__(self, callback:Callable = None):
+        self.callback = callback
+        self.timings = {}
+        self.counts = {}
+        self.info = {}
+        self.iterations = []
+        self._lock = threading.Lock()
+
+    def add_time(self, phase:str, seconds:float):
+        """Add `seconds` to the time of `phase`."""
+        with self._lock:
+            self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, phase:str):
+        """Context manager adding the wall time of its block to `phase`."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - t0)
+
+    def add_count(self, name:str, n:int):
+        """Add `n` to the counter `name`."""
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def unfilled(self):
+        """Number of pixels left unfilled (NaN), by reason: 'nan' (NaN outside the mask, kept with `fill_nans=False`),
+        'max_distance', 'max_iterations' and 'no_data' (no valid pixel to be filled from, e.g. in an all-NaN image)."""
+        with self._lock:
+            return {name[len('unfilled_'):]: n for name, n in self.counts.items() if name.startswith('unfilled_')}
+
+    def add_iteration(self, record:dict):
+        """Store an iteration record and pass it to the callback."""
+        with self._lock:
+            self.iterations.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def to_dict(self):
+        """JSON-serializable report, with the iteration times summed up in 'iteration_totals'."""
+        with self._lock:
+            iterations = list(self.iterations)
+            totals = {key: sum(record[key] for record in iterations) for key in ['find_seconds', 'fill_seconds', 'io_seconds']}
+            return dict(info=dict(self.info), timings=dict(self.timings), counts=dict(self.counts),
+                        n_iterations=len(iterations), iteration_totals=totals, iterations=iterations)
+
+    def write(self, filename:str):
+        """Write the report (see `to_dict`) to a JSON file."""
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+
+def _timed(stats:FillStats, phase:str):
+    """`stats.timer(phase)`, or a context manager that does nothing if `stats` is None."""
+    return stats.timer(phase) if stats is not None else nullcontext()
+
+
 def maskfill(input_image : Union[str,np.ndarray], 
             mask : Union[str,np.ndarray], 
-            ext : int = 0, 
+            ext : Union[int,str,list] = 0, 
             size : int = 3, 
             operator : str = 'median', 
             smooth : bool = True, 
-            writesteps : bool = False, 
+            writesteps : Union[bool,str] = False, 
             output_file : str = None, 
-            verbose : bool = False):
+            verbose : bool = False,
+            n_jobs : int = 1,
+            low_memory : bool = False,
+            out : np.ndarray = None,
+            dtype : Union[str,np.dtype] = None,
+            stats : FillStats = None,
+            keep_unsmoothed : bool = True,
+            method : str = 'iterative',
+            backend : str = 'numpy',
+            strip_rows : int = None,
+            cache : Union[str,ResultCache] = None,
+            max_iterations : int = None,
+            max_distance : float = None,
+            fill_nans : bool = True):
     """Maskfill function used to smoothly iteratively fill masks in images. 
     See van Dokkum et al. 2023 (PASP) for details.
 
     Parameters
     ----------
     input_image : Union[str,np.ndarray]
-        input image; either a path to a `.fits` file or a numpy ndarray
+        input image; either a path to a `.fits` file or a numpy ndarray. 
+        A 3D cube (e.g., a stack of frames) is filled plane by plane, each plane independently of the others. The planes of a
+        cube of small frames (up to 2**17 pixels each, e.g., postage stamps) are filled together, in one vectorized pass per
+        iteration, which is much faster than calling `maskfill` for each of them.
     mask : Union[str,np.ndarray]
         mask image; either a path to a `.fits` file or a numpy ndarray [0 = good, 1 = bad/fill location]
         Note that any NaN values in the mask file will be ignored (i.e., treated as 0). 
-    ext : int, optional
-        fits extension in input and mask where data are stored, by default 0
+        For a cube, the mask can be a cube of the same shape or a 2D mask applied to every plane.
+    ext : Union[int,str,list], optional
+        fits extension in input and mask where data are stored, by default 0.
+        A list of extensions, or 'all' for every extension containing an image, fills each of them, reading the files only once.
+        The mask is then taken from the same extension of the mask file, unless that file holds a single image, which is used for all extensions.
     size : int, optional
         size for the filter to use (must be odd) --- a size of three implies the 8 pixels surrounding 1 pixel are considered, by default 3
     operator : str, optional
         fill operator either 'median' or 'mean', by default 'median'
     smooth : bool, optional
         whether to boxcar smooth the filled pixels using a mean with kernel = `size` after filling, by default True
-    writesteps : bool, optional
-        if True, save the output image of each iteration of the filling process, by default False
+    writesteps : Union[bool,str], optional
+        if True, save the output image of each iteration of the filling process (as `_iter_<iteration>.fits`), by default False.
+        A file name instead records only the pixels filled in each iteration, and writes them to that single fits file
+        at the end: a table with one row (iteration, row, column, value) per filled pixel, so that its size is set by
+        the mask rather than by the image and the number of iterations. `iteration_map` reads it back as an image of
+        the iteration in which each pixel was filled.
     output_file : str, optional
         Write the final image to a fits file (if smoothing is enabled, a second extension with the non-smoothed version will be added), by default None
     verbose : bool, optional
         Flag for verbose messages during the filling, by default False
+    n_jobs : int, optional
+        number of threads used to fill independent masked regions, cube planes or extensions in parallel (-1 uses all cores), by default 1.
+        The result is identical to the serial run. Not used with `writesteps`, which fills the whole frame at once.
+    low_memory : bool, optional
+        Keep peak memory close to the size of the image, by default False. A fits input is filled directly in its (copy-on-write) 
+        memory map, so only the pages holding masked pixels are ever copied into memory (scaled data, with BZERO, BSCALE 
+        or BLANK set, cannot be memory-mapped and are read into memory); no separate unsmoothed copy is kept 
+        (the second output is None), and the output file is streamed to disk in chunks. Only for a single extension.
+    out : np.ndarray, optional
+        preallocated array of the image's shape that receives the filled (and smoothed) image, by default None.
+        Passing the input array itself fills it in place. Only for a single extension.
+    dtype : Union[str,np.dtype], optional
+        dtype of the returned (and written) images, by default None (the working dtype below).
+        The fill works in floating point: float32 and float64 images keep their dtype end to end, while integer (and float16) 
+        images are promoted once, to np.result_type(dtype, np.float32), i.e., float32 for 8- and 16-bit integers and float64 
+        for 32- and 64-bit ones. A floating `dtype` is used as the working dtype; an integer `dtype` rounds the result to the 
+        nearest integer (all pixels must then have been filled).
+    stats : FillStats, optional
+        instrumentation object that records the time of each phase (reading, filling, smoothing, writing) and,
+        per iteration, the frontier size, the pixels remaining and the time spent on each step, by default None
+    keep_unsmoothed : bool, optional
+        return the unsmoothed image as the second output, by default True. If False, the smoothing is done in place in the
+        filled image, so no second full-size image is kept (the second output is None); the output file still holds both
+        versions. With a list of extensions or 'all', the unsmoothed images are still made (for the output file), and only
+        the second output is None.
+    method : str, optional
+        fill method, by default 'iterative', which fills the masks from their edges inwards, one pixel layer per iteration.
+        'pyramid' fills large masks coarse to fine: the image is repeatedly downsampled by 2, the coarsest level is filled,
+        and each finer level starts from the upsampled fill, refining only a band of a few pixels along the mask edges.
+        The number of iterations then grows with the log of the mask radius instead of with the radius, while the result
+        stays close to the iterative one. 'distance' orders the masked pixels by their Euclidean distance to the nearest
+        unmasked pixel, computed once, and fills them in that order in a single sweep, in shells one pixel thick, each
+        from the shells before it; the fill thus advances in circles rather than in the squares of the iterative method.
+        Not used with `writesteps`.
+    backend : str, optional
+        engine that evaluates the operator on the windows of the pixels being filled or smoothed, by default 'numpy'.
+        'numpy' gathers the windows of all pixels of an iteration and reduces them at once; 'numba' runs compiled
+        per-pixel kernels (requires Numba, and falls back to 'numpy' with a warning without it), which is fastest
+        for the median with the default `size`; 'python' calls np.nanmedian or np.nanmean on each window in turn,
+        as the original implementation did (slow, mostly useful as a reference). All backends give identical results.
+    strip_rows : int, optional
+        stream the image through memory in horizontal strips of this many rows, for images larger than memory, by default None.
+        The image (and the mask, if it is a file) are read strip by strip, and each filled strip is written to `output_file`
+        before the next one is read; both outputs are then None. Each strip is read with a halo of rows above and below it,
+        wide enough to hold all data the fill of its masked pixels depends on (about `size // 2` times the depth of the masks,
+        widened where needed), so the output is identical to filling the whole image. Requires a fits `input_image` and an `output_file`, a 2D
+        image and a single extension, and the iterative method; not supported with `writesteps`, `low_memory`, `out` or `n_jobs`.
+    cache : Union[str,ResultCache], optional
+        directory of an on-disk cache of results, or a `ResultCache` (to set its size limit or read its hit and miss
+        counts), by default None. A result is looked up by a hash of the image, the mask, `size`, `operator`, `smooth`,
+        `method`, `dtype` and the package version; a hit returns the stored images, memory-mapped read-only, without
+        filling. On a miss, the unsmoothed image is kept (even with `keep_unsmoothed=False`) to be stored. Only for a
+        single extension; not used with `writesteps`, `low_memory`, `out` or `strip_rows`.
+    max_iterations : int, optional
+        stop the fill of each masked region (or cube plane) after this many iterations, by default None (fill until done).
+        With the iterative method, an iteration fills one pixel layer, so this also bounds the fill depth.
+    max_distance : float, optional
+        only fill pixels within this Euclidean distance (in pixels) of the nearest valid pixel, by default None.
+        The pixels farther away stay NaN and are not used to fill the others.
+    fill_nans : bool, optional
+        also fill the NaNs of the image outside the mask, by default True. If False, only the masked pixels are filled,
+        and pre-existing NaNs are kept (and, as always, not used as data).
+
+    With `max_iterations`, `max_distance` or `fill_nans=False`, some pixels may be left NaN; they are not smoothed.
+    The number of pixels left unfilled, by reason, is recorded in `stats` (see `FillStats.unfilled`). These
+    options are not supported with the pyramid method, `strip_rows` or an integer `dtype`.
 
     Returns
     -------
@@ -114,6 +871,9 @@ def maskfill(input_image : Union[str,np.ndarray],
         One can ignore the second output by calling `smoothed_output, _ = maskfill(...)`
         Similarly, if an output filename is provided, the 0th extension will have the output image smoothed if smoothing was
         requested, or unsmoothed if not. If smoothing was requested, the unsmoothed version will be stored in the 1st extension.
+        With a list of extensions or 'all', both outputs are lists with one array per extension, and the output file
+        is a copy of the input file (with its headers) in which the selected extensions are filled (and smoothed); 
+        the unsmoothed versions are then appended as extensions named '<EXTNAME>_NOSMOOTH'.
     """
     if operator == 'median':
         operator_func = np.nanmedian 
@@ -123,107 +883,769 @@ def maskfill(input_image : Union[str,np.ndarray],
         raise ValueError('Operator must be mean or median.')
     if size % 2 == 0:
         raise ValueError("Window_size must be odd")
-    if isinstance(input_image, str):
-        if not input_image.endswith('.fits'):
-            input_image+='.fits'
-        im = fits.getdata(input_image, ext)
-    else:
-        im = input_image
-    if isinstance(mask, str):
-        if not mask.endswith('.fits'):
-            mask+='.fits'
-        mask = fits.getdata(mask, ext)
-        mask = np.array(mask, dtype=bool)
+    if method not in _FILL_METHODS:
+        raise ValueError(f'Method must be one of {", ".join(_FILL_METHODS)}.')
+    if writesteps and method != 'iterative':
+        raise ValueError('writesteps is only supported with the iterative method.')
+    backend = _resolve_backend(backend)
+    if strip_rows is not None:
+        if not isinstance(input_image, str) or output_file is None:
+            raise ValueError('strip_rows requires a fits file as input_image and an output_file.')
+        if isinstance(ext, (list, tuple)) or ext == 'all' or method != 'iterative' or writesteps or out is not None or low_memory or n_jobs != 1:
+            raise ValueError('strip_rows is only supported for a single extension, with the iterative method, without writesteps, '
+                             'low_memory, out or n_jobs.')
+        if strip_rows < 1:
+            raise ValueError('strip_rows must be a positive integer.')
+    if cache is not None:
+        if isinstance(ext, (list, tuple)) or ext == 'all' or writesteps or low_memory or out is not None or strip_rows is not None:
+            raise ValueError('cache is only supported for a single extension, without writesteps, low_memory, out or strip_rows.')
+        cache = _as_cache(cache)
+    if max_iterations is not None or max_distance is not None or not fill_nans:
+        if method == 'pyramid' or strip_rows is not None:
+            raise ValueError('max_iterations, max_distance and fill_nans=False are not supported with the pyramid method or strip_rows.')
+        if max_iterations is not None and max_iterations < 1:
+            raise ValueError('max_iterations must be a positive integer.')
+        if max_distance is not None and max_distance <= 0:
+            raise ValueError('max_distance must be positive.')
+        if dtype is not None and np.issubdtype(dtype, np.integer):
+            raise ValueError('max_iterations, max_distance and fill_nans=False can leave NaNs, which an integer dtype cannot hold.')
+    if stats is not None:
+        stats.info.update(size=size, operator=operator, smooth=smooth, method=method, backend=backend)
+    limits = dict(max_iterations=max_iterations, max_distance=max_distance, fill_nans=fill_nans)
+    with _timed(stats, 'total'):
+        if strip_rows is not None:
+            return _maskfill_strips(input_image, mask, ext, size // 2, operator_func, strip_rows, smooth=smooth,
+                                    output_file=output_file, verbose=verbose, dtype=dtype, stats=stats, backend=backend)
+        if isinstance(ext, (list, tuple)) or ext == 'all':
+            if low_memory or out is not None:
+                raise ValueError('low_memory and out are only supported for a single extension.')
+            result = _maskfill_extensions(input_image, mask, ext, size // 2, operator_func, smooth=smooth,
+                                          output_file=output_file, verbose=verbose, n_jobs=n_jobs, dtype=dtype, stats=stats, method=method,
+                                          backend=backend, **limits)
+            if not keep_unsmoothed:
+                return result[0], None
+            return result
+        with _timed(stats, 'read'):
+            if isinstance(input_image, str):
+                from astropy.io import fits
+                if not input_image.endswith('.fits'):
+                    input_image+='.fits'
+                # astropy cannot memory-map scaled data (BZERO, BSCALE or BLANK set), which are read into memory
+                scaled = low_memory and any(keyword in fits.getheader(input_image, ext) for keyword in ['BZERO', 'BSCALE', 'BLANK'])
+                im = fits.getdata(input_image, ext, memmap=low_memory and not scaled)
+                if low_memory and out is None and im.flags.writeable and _working_dtype(im.dtype, dtype) == im.dtype.newbyteorder('='):
+                    # fill the copy-on-write memory map itself: untouched pages are never loaded into memory (it
+                    # stays big-endian, so the numba backend uses the numpy engine for it)
+                    out = im
+            else:
+                im = np.asarray(input_image)
+            if isinstance(mask, str):
+                from astropy.io import fits
+                if not mask.endswith('.fits'):
+                    mask+='.fits'
+                mask = fits.getdata(mask, ext)
+                mask = np.array(mask, dtype=bool)
+            else:
+                mask = np.array(mask, dtype=bool)
+        if np.isnan(mask).any():
+            if verbose:
+                print('Mask contained NaNs! NaNs in mask are ignored (only pixels with value 1 are infilled).')
+            mask[np.isnan(mask)] = 0
+        if stats is not None:
+            stats.info.update(shape=list(im.shape), dtype=str(im.dtype), masked_pixels=int(np.count_nonzero(mask)))
+        if cache is not None:
+            result = _cached_fill(cache, im, mask, size, operator, smooth=smooth, verbose=verbose, n_jobs=n_jobs, dtype=dtype,
+                                  stats=stats, method=method, backend=backend, **limits)
+        elif low_memory or not keep_unsmoothed:
+            return _maskfill_low_memory(im, mask, size // 2, operator_func, smooth=smooth, writesteps=writesteps,
+                                        output_file=output_file, verbose=verbose, n_jobs=n_jobs, out=out, dtype=dtype, stats=stats,
+                                        method=method, backend=backend, **limits)
+        else:
+            result = _maskfill_array(im, mask, size // 2, operator_func, smooth=smooth, writesteps=writesteps, verbose=verbose,
+                                     n_jobs=n_jobs, out=out, dtype=dtype, stats=stats, method=method, backend=backend, **limits)
+        if output_file is not None:
+            _write_output(output_file, result, smooth=smooth, verbose=verbose, stats=stats)
+        if not keep_unsmoothed:
+            return result[0], None
+        return result
+
+
+def _cached_fill(cache:ResultCache, im:np.ndarray, mask:np.ndarray, size:int, operator:str, smooth:bool = True, verbose:bool = False,
+                 n_jobs:int = 1, dtype:Union[str,np.dtype] = None, stats:FillStats = None, method:str = 'iterative', backend:str = 'numpy',
+                 max_iterations:int = None, max_distance:float = None, fill_nans:bool = True):
+    """`_maskfill_array` through `cache`: the stored result for this image, mask and settings, or a new one, which is stored."""
+    with _timed(stats, 'cache'):
+        # the backend and n_jobs do not change the result, so they are not part of the key
+        key = cache.key(im, mask, size=size, operator=operator, smooth=smooth, method=method,
+                        dtype=None if dtype is None else np.dtype(dtype).str, version=__version__,
+                        max_iterations=max_iterations, max_distance=max_distance, fill_nans=fill_nans)
+        result = cache.get(key)
+    if stats is not None:
+        stats.add_count('cache_hits' if result is not None else 'cache_misses', 1)
+    if result is not None:
+        if verbose:
+            print(f'Result found in the cache: {key}')
+        return result
+    result = _maskfill_array(im, mask, size // 2, np.nanmedian if operator == 'median' else np.nanmean, smooth=smooth, verbose=verbose,
+                             n_jobs=n_jobs, dtype=dtype, stats=stats, method=method, backend=backend, max_iterations=max_iterations,
+                             max_distance=max_distance, fill_nans=fill_nans)
+    with _timed(stats, 'cache'):
+        cache.put(key, result)
+    return result
+
+
+def _write_output(output_file:str, result:tuple, smooth:bool = True, verbose:bool = False, stats:FillStats = None):
+    """Write the (smoothed, unsmoothed) `result` of `maskfill` to `output_file`, as maskfill(..., output_file=...) does."""
+    from astropy.io import fits
+    if not output_file.endswith('.fits'):
+        output_file +='.fits'
+    with _timed(stats, 'write'):
+        if smooth:
+            header = fits.Header() 
+            header['EXT0'] = 'Filled Smoothed Image'
+            header['EXT1'] = 'Filled Image (no smoothing)'
+            hdu0 = fits.PrimaryHDU(result[0],header=header)
+            hdu1 = fits.ImageHDU(result[1])
+            hdul = fits.HDUList([hdu0,hdu1])
+            hdul.writeto(output_file,overwrite=True)
+        else:
+            hdu = fits.PrimaryHDU(result[0])
+            hdu.writeto(output_file,overwrite=True)
+    if verbose:
+        print(f'Output written to: {output_file}')
+
+
+def _fill_in_place(output:np.ndarray, mask:np.ndarray, pad_width:int, operator_func:Callable,
+                   writesteps:Union[bool,str] = False, verbose:bool = False, n_jobs:int = 1, stats:FillStats = None, label:str = '',
+                   method:str = 'iterative', backend:str = 'numpy', max_iterations:int = None, max_distance:float = None,
+                   fill_nans:bool = True):
+    """Fill the masked and NaN pixels of a 2D image, or of every plane of a 3D cube, in place.
+
+    `max_iterations`, `max_distance` and `fill_nans` limit the fill as described in `maskfill`.
+    """
+    if (output.ndim == 3 and output[0].size <= _MIN_SPLIT_AREA and method == 'iterative' and output.flags.c_contiguous
+            and max_distance is None):
+        _fill_stack(output, mask, pad_width, operator_func, verbose=verbose, n_jobs=n_jobs, stats=stats, label=label, backend=backend,
+                    max_iterations=max_iterations, fill_nans=fill_nans)
+    elif output.ndim == 3:
+        # planes are independent; parallelize over them rather than over the regions within a plane
+        _map_jobs(lambda plane: _fill_in_place(output[plane], mask[plane], pad_width, operator_func, verbose=verbose,
+                                               stats=stats, label=f'{label}plane {plane}, ', method=method, backend=backend,
+                                               max_iterations=max_iterations, max_distance=max_distance, fill_nans=fill_nans),
+                  range(output.shape[0]), n_jobs)
     else:
-        mask = np.array(mask, dtype=bool)
-    if np.isnan(mask).any():
+        holes = _fill_targets(output, mask, fill_nans=fill_nans, max_distance=max_distance, stats=stats)
+        only_holes = not fill_nans or max_distance is not None
+        if only_holes:
+            # the masked pixels left out stay NaN, and are not used as data
+            output[mask] = np.nan
+        if writesteps:
+            # intermediate images need the whole frame at every iteration
+            output[mask] = np.nan
+            # a file name: only the pixels filled in each iteration are kept, and written to that file at the end
+            steps = [] if isinstance(writesteps, str) else None
+            iterations = _iterative_fill(output, pad_width, operator_func, writesteps=steps is None, verbose=verbose, stats=stats,
+                                         label=f'{label}full frame', backend=backend, fillable=holes if only_holes else None,
+                                         max_iterations=max_iterations, steps=steps)
+            if steps is not None:
+                with _timed(stats, 'write'):
+                    _write_steps(writesteps, steps, output.shape, output.dtype, verbose=verbose)
+            if stats is not None:
+                _count_unfilled(stats, np.count_nonzero(np.isnan(output[holes])), iterations, max_iterations)
+        else:
+            _fill_regions(output, holes, pad_width, operator_func, verbose=verbose, n_jobs=n_jobs, stats=stats, label=label,
+                          method=method, backend=backend, only_holes=only_holes, max_iterations=max_iterations)
+
+
+def _write_steps(steps_file:str, steps:list, shape:tuple, dtype:np.dtype, verbose:bool = False):
+    """Write the (rows, cols, values) filled in each iteration (see `_iterative_fill`) to `steps_file`: a fits table
+    'STEPS' with one row per filled pixel and the columns 'ITER', 'ROW', 'COL' and 'VALUE', in the order of filling.
+    The primary header holds the image shape ('IMHEIGHT', 'IMWIDTH') and the number of iterations ('NITER')."""
+    from astropy.io import fits
+    if not steps_file.endswith('.fits'):
+        steps_file += '.fits'
+    iterations = np.repeat(np.arange(1, len(steps) + 1, dtype=np.int32), [rows.size for rows, _, _ in steps])
+    rows, cols, values = (np.concatenate([np.empty(0, dtype=column_dtype)] + [step[i] for step in steps])
+                          for i, column_dtype in enumerate([np.intp, np.intp, dtype]))
+    header = fits.Header()
+    header['IMHEIGHT'], header['IMWIDTH'] = shape
+    header['NITER'] = len(steps)
+    table = fits.BinTableHDU.from_columns([fits.Column(name='ITER', format='J', array=iterations),
+                                           fits.Column(name='ROW', format='J', array=rows),
+                                           fits.Column(name='COL', format='J', array=cols),
+                                           fits.Column(name='VALUE', format='E' if dtype == np.float32 else 'D', array=values)],
+                                          name='STEPS')
+    fits.HDUList([fits.PrimaryHDU(header=header), table]).writeto(steps_file, overwrite=True)
+    if verbose:
+        print(f'Filled pixels of {len(steps)} iterations written to: {steps_file}')
+
+
+def iteration_map(steps_file:str):
+    """Iteration in which each pixel was filled, from a file written by maskfill(..., writesteps=steps_file).
+
+    Parameters
+    ----------
+    steps_file : str
+        fits file with the pixels filled in each iteration
+
+    Returns
+    -------
+    np.ndarray
+        int32 image of the shape of the filled image, holding for each pixel the iteration (from 1) in which it was
+        filled, or 0 if it was not filled
+    """
+    from astropy.io import fits
+    with fits.open(steps_file) as hdul:
+        header, steps = hdul[0].header, hdul['STEPS'].data
+        iterations = np.zeros((header['IMHEIGHT'], header['IMWIDTH']), dtype=np.int32)
+        iterations[steps['ROW'], steps['COL']] = steps['ITER']
+    return iterations
+
+
+def _fill_targets(output:np.ndarray, mask:np.ndarray, fill_nans:bool = True, max_distance:float = None, stats:FillStats = None):
+    """The pixels of a 2D image to fill: the masked pixels and, unless `fill_nans` is False, the NaNs, except those
+    farther than `max_distance` (Euclidean, in pixels) from the nearest valid pixel. The pixels left out are counted
+    in `stats` as 'unfilled_nan' and 'unfilled_max_distance'."""
+    unknown = mask | np.isnan(output)
+    if fill_nans and max_distance is None:
+        return unknown
+    targets = unknown if fill_nans else np.array(mask)
+    if stats is not None and not fill_nans:
+        stats.add_count('unfilled_nan', int(np.count_nonzero(unknown) - np.count_nonzero(mask)))
+    if max_distance is not None:
+        rows, cols = np.nonzero(unknown)
+        far = _squared_distances(unknown, rows, cols) > max_distance**2
+        rows, cols = rows[far], cols[far]
+        if stats is not None:
+            stats.add_count('unfilled_max_distance', int(np.count_nonzero(targets[rows, cols])))
+        targets[rows, cols] = False
+    return targets
+
+
+def _fill_stack(output:np.ndarray, mask:np.ndarray, pad_width:int, operator_func:Callable, verbose:bool = False, n_jobs:int = 1,
+                stats:FillStats = None, label:str = '', backend:str = 'numpy', max_iterations:int = None, fill_nans:bool = True):
+    """Fill the masked and NaN pixels of all planes of a (C-contiguous) cube at once, in place.
+
+    The planes are stacked into one image of planes (see `_plane_rows`), so each iteration gathers and
+    reduces the frontier windows of all planes in a single pass, and planes that are done drop out of the
+    frontier. This is much faster than filling many small planes one by one. With `n_jobs`, the planes are
+    split into that many groups, filled in parallel. `max_iterations` and `fill_nans` are as in `maskfill`.
+    """
+    n_planes, height, width = output.shape
+    n_groups = min(n_planes, (os.cpu_count() or 1) if n_jobs == -1 else max(n_jobs, 1))
+
+    def fill_group(planes):
+        stacked = output[planes].reshape(-1, width)
+        stacked_mask = mask[planes].reshape(-1, width)
+        holes = stacked_mask if not fill_nans else stacked_mask | np.isnan(stacked)
+        if stats is not None and not fill_nans:
+            stats.add_count('unfilled_nan', int(np.count_nonzero(np.isnan(stacked) & ~stacked_mask)))
+        stacked[stacked_mask] = np.nan
         if verbose:
-            print('Mask contained NaNs! NaNs in mask are ignored (only pixels with value 1 are infilled).')
-        mask[np.isnan(mask)] = 0
-    output = np.copy(im)
-    output[mask] = np.nan
-    pad_width = size // 2
-    counter = 1
+            print(f'Planes {planes.start}-{planes.stop - 1}')
+        iterations = _iterative_fill(stacked, pad_width, operator_func, verbose=verbose, stats=stats,
+                                     label=f'{label}planes {planes.start}-{planes.stop - 1}', plane_height=height, backend=backend,
+                                     fillable=None if fill_nans else holes, max_iterations=max_iterations)
+        if stats is not None:
+            _count_unfilled(stats, np.count_nonzero(np.isnan(stacked[holes])), iterations, max_iterations)
+
+    bounds = np.linspace(0, n_planes, n_groups + 1).astype(int)
+    _map_jobs(fill_group, [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])], n_jobs)
+
+
+def _smoothed_pixels(output:np.ndarray, mask:np.ndarray, max_iterations:int = None, max_distance:float = None,
+                     fill_nans:bool = True):
+    """The masked pixels to smooth after a fill: those that were filled, if the fill was limited (see `maskfill`)."""
+    if max_iterations is None and max_distance is None and fill_nans:
+        return mask
+    return mask & ~np.isnan(output)
+
+
+def _smooth_values(output:np.ndarray, mask:np.ndarray, pad_width:int, backend:str = 'numpy'):
+    """Boxcar-smoothed values of the masked pixels of `output`, in the order of `output[mask]`, leaving `output` untouched."""
+    height, width = output.shape[-2:]
+    # the planes of a cube are smoothed together, as one image of stacked planes (see `_plane_rows`)
+    rows, cols = np.nonzero(mask.reshape(-1, width))
+    if backend == 'numpy':
+        return _apply_window_operator(output.reshape(-1, width), rows, cols, pad_width, _boxcar_mean_windows, plane_height=height)
+    return _BACKENDS[backend](output.reshape(-1, width), rows, cols, pad_width, np.nanmean, plane_height=height)
+
+
+def _smooth_in_place(output:np.ndarray, mask:np.ndarray, pad_width:int, backend:str = 'numpy'):
+    """Boxcar smooth the masked pixels of a 2D image, or of every plane of a 3D cube, in place."""
+    # the same as process_masked_pixels(output, pad_width, mask=mask, operator_func=np.nanmean) for each plane
+    output[mask] = _smooth_values(output, mask, pad_width, backend=backend)
+
+
+def _working_dtype(dtype:np.dtype, requested:Union[str,np.dtype] = None):
+    """Floating point dtype in which an image of `dtype` is filled (see the `dtype` argument of `maskfill`).
+
+    Always in native byte order: fits data are big-endian, and the compiled kernels only take native floats.
+    """
+    if requested is not None and np.issubdtype(requested, np.floating):
+        working = np.dtype(requested)
+    elif np.issubdtype(dtype, np.floating) and np.dtype(dtype).itemsize >= 4:
+        working = np.dtype(dtype)
+    else:
+        working = np.result_type(dtype, np.float32)
+    return working.newbyteorder('=')
+
+
+def _cast_output(output:np.ndarray, dtype:Union[str,np.dtype] = None):
+    """Convert a filled image to the requested output dtype (integers are rounded)."""
+    if output is None or dtype is None or output.dtype == dtype:
+        return output
+    if np.issubdtype(dtype, np.integer):
+        if np.isnan(output).any():
+            raise ValueError(f'Cannot convert an image with unfilled (NaN) pixels to {np.dtype(dtype)}.')
+        return np.rint(output).astype(dtype)
+    return output.astype(dtype)
+
+
+def _prepare_output(im:np.ndarray, mask:np.ndarray, writesteps:Union[bool,str] = False, out:np.ndarray = None, dtype:Union[str,np.dtype] = None):
+    """Check the image and mask shapes, and return the (broadcast) mask and the buffer to fill.
+
+    The buffer is `out` holding a copy of `im` (or `im` itself if `out is im`), or a new copy of `im`
+    in the working dtype.
+    """
+    if im.ndim == 3 and mask.ndim == 2:
+        mask = np.broadcast_to(mask, im.shape)
+    if im.ndim not in (2, 3) or mask.shape != im.shape:
+        raise ValueError(f'Image of shape {im.shape} must be 2D or 3D, with a mask of the same shape (or a 2D mask for a cube); got mask of shape {mask.shape}.')
+    if writesteps and im.ndim == 3:
+        raise ValueError('writesteps is only supported for 2D images.')
+    if out is None:
+        # the only conversion of the image: integers are promoted here, floats are copied as they are
+        return mask, np.array(im, dtype=_working_dtype(im.dtype, dtype))
+    if out.shape != im.shape:
+        raise ValueError(f'Output buffer of shape {out.shape} does not match the image shape {im.shape}.')
+    if not np.issubdtype(out.dtype, np.floating):
+        raise ValueError(f'Output buffer must have a floating point dtype, not {out.dtype}.')
+    if out is not im:
+        np.copyto(out, im)
+    return mask, out
+
+
+def _maskfill_array(im:np.ndarray, mask:np.ndarray, pad_width:int, operator_func:Callable, smooth:bool = True,
+                    writesteps:Union[bool,str] = False, verbose:bool = False, n_jobs:int = 1, out:np.ndarray = None,
+                    dtype:Union[str,np.dtype] = None, stats:FillStats = None, label:str = '', method:str = 'iterative',
+                    backend:str = 'numpy', max_iterations:int = None, max_distance:float = None, fill_nans:bool = True):
+    """Fill a 2D image, or a 3D cube plane by plane, and return the outputs in the order `maskfill` does.
+
+    A 2D mask is applied to every plane of a cube.
+    """
+    with _timed(stats, 'prepare'):
+        mask, output = _prepare_output(im, mask, writesteps=writesteps, out=out, dtype=dtype)
     if verbose:
         print('Starting Masked Pixel Fill.')
-    while np.isnan(output).any():
-        if verbose:
-            print(f'On iteration {counter} | Masked pixels remaining: {np.isnan(output).sum()}')
-        output = process_masked_pixels(input_image=output, pad_width=pad_width,operator_func=operator_func)
-        if writesteps:
-            fits.writeto(f"_iter_{counter}.fits", output, overwrite=True)
-            if verbose:
-                print(f'Intermediate fits written to: {f"_iter_{counter}.fits"}.')
-        counter += 1
+    with _timed(stats, 'fill'):
+        _fill_in_place(output, mask, pad_width, operator_func, writesteps=writesteps, verbose=verbose, n_jobs=n_jobs,
+                       stats=stats, label=label, method=method, backend=backend, max_iterations=max_iterations,
+                       max_distance=max_distance, fill_nans=fill_nans)
+    if verbose:
+        print('Pixel replacement complete.')
+    if not smooth:
+        return _cast_output(output, dtype), None
+    mask = _smoothed_pixels(output, mask, max_iterations, max_distance, fill_nans)
+    output1 = np.copy(output)
+    if verbose:
+        print('Boxcar smoothing the masked areas.')
+    with _timed(stats, 'smooth'):
+        _smooth_in_place(output, mask, pad_width, backend=backend)
+    if verbose:
+        print('Smoothing complete.')
+    return _cast_output(output, dtype), _cast_output(output1, dtype)
+
+
+# number of values written per chunk when streaming an image to a fits file
+_STREAM_CHUNK_ELEMENTS = 2**22
+_BITPIX = {'uint8': 8, 'int16': 16, 'int32': 32, 'int64': 64, 'float32': -32, 'float64': -64}
+
+
+def _streaming_hdu(output_file:str, shape:tuple, dtype:Union[str,np.dtype], header:'fits.Header' = None):
+    """Start a new HDU of `shape` and `dtype` at the end of `output_file` (the primary HDU if the file does not
+    exist yet), whose data are then written in order, in pieces, with `hdu.write` (and finished with `hdu.close`)."""
+    from astropy.io import fits
+    dtype = np.dtype(dtype)
+    if dtype.name not in _BITPIX:
+        raise ValueError(f'Cannot stream {dtype} data to a fits file.')
+    stream_header = fits.Header([('SIMPLE', True), ('BITPIX', _BITPIX[dtype.name]), ('NAXIS', len(shape))] +
+                                [(f'NAXIS{axis}', n) for axis, n in enumerate(shape[::-1], start=1)])
+    if not os.path.exists(output_file):
+        stream_header['EXTEND'] = True
+    if header is not None:
+        stream_header.extend(header, strip=True)
+    return fits.StreamingHDU(output_file, stream_header)
+
+
+def _stream_hdu(output_file:str, data:np.ndarray, header:'fits.Header' = None, dtype:Union[str,np.dtype] = None):
+    """Append `data` to `output_file` as a new HDU (the primary HDU if the file does not exist yet),
+    writing it in chunks along its first axis, converted to `dtype` (see `_cast_output`) chunk by chunk,
+    so that no full-size converted or byte-swapped copy is made."""
+    hdu = _streaming_hdu(output_file, data.shape, dtype if dtype is not None else data.dtype, header)
+    chunk = max(1, _STREAM_CHUNK_ELEMENTS // max(1, data[0].size))
+    for start in range(0, data.shape[0], chunk):
+        hdu.write(_cast_output(data[start:start + chunk], dtype))
+    hdu.close()
+
 
+def _maskfill_low_memory(im:np.ndarray, mask:np.ndarray, pad_width:int, operator_func:Callable, smooth:bool = True,
+                         writesteps:Union[bool,str] = False, output_file:str = None, verbose:bool = False, n_jobs:int = 1, out:np.ndarray = None,
+                         dtype:Union[str,np.dtype] = None, stats:FillStats = None, method:str = 'iterative',
+                         backend:str = 'numpy', max_iterations:int = None, max_distance:float = None, fill_nans:bool = True):
+    """Fill `im` in a single output buffer without keeping an unsmoothed copy, streaming the result to `output_file`.
+
+    Only the unsmoothed and smoothed values of the masked pixels are kept aside, to write both versions
+    of the image from the same buffer. Used for `low_memory` and `keep_unsmoothed=False`. Returns `(output, None)`.
+    """
+    with _timed(stats, 'prepare'):
+        mask, output = _prepare_output(im, mask, writesteps=writesteps, out=out, dtype=dtype)
+    if verbose:
+        print('Starting Masked Pixel Fill.')
+    with _timed(stats, 'fill'):
+        _fill_in_place(output, mask, pad_width, operator_func, writesteps=writesteps, verbose=verbose, n_jobs=n_jobs, stats=stats,
+                       method=method, backend=backend, max_iterations=max_iterations, max_distance=max_distance,
+                       fill_nans=fill_nans)
     if verbose:
         print('Pixel replacement complete.')
-    output1 = np.copy(output)       
     if smooth:
+        mask = _smoothed_pixels(output, mask, max_iterations, max_distance, fill_nans)
         if verbose:
             print('Boxcar smoothing the masked areas.')
-        smoothed_output = process_masked_pixels(input_image=output,pad_width=pad_width,mask=mask,operator_func=np.nanmean)
+        with _timed(stats, 'smooth'):
+            smoothed_values = _smooth_values(output, mask, pad_width, backend=backend)
+            unsmoothed_values = output[mask] if output_file is not None else None
+            output[mask] = smoothed_values
         if verbose:
             print('Smoothing complete.')
-
     if output_file is not None:
         if not output_file.endswith('.fits'):
             output_file +='.fits'
+        if dtype is not None and np.issubdtype(dtype, np.integer) and np.isnan(output).any():
+            # checked before the output file is removed and streamed, which the conversion would otherwise abort halfway
+            raise ValueError(f'Cannot convert an image with unfilled (NaN) pixels to {np.dtype(dtype)}.')
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        with _timed(stats, 'write'):
+            if smooth:
+                from astropy.io import fits
+                header = fits.Header() 
+                header['EXT0'] = 'Filled Smoothed Image'
+                header['EXT1'] = 'Filled Image (no smoothing)'
+                _stream_hdu(output_file, output, header, dtype=dtype)
+                output[mask] = unsmoothed_values
+                _stream_hdu(output_file, output, dtype=dtype)
+                output[mask] = smoothed_values
+            else:
+                _stream_hdu(output_file, output, dtype=dtype)
+        if verbose:
+            print(f'Output written to: {output_file}')
+    return _cast_output(output, dtype), None
+
+
+def _read_strip(image_data, mask_data, start:int, stop:int, pad_width:int, dtype:np.dtype):
+    """Read rows start:stop of the image and mask (fits sections or arrays) with the halo described in `_maskfill_strips`.
+
+    Returns `(image, mask, top, bottom)`: the image (in `dtype`) and mask of rows top:bottom.
+    """
+    height = mask_data.shape[0]
+    top, bottom = max(start - pad_width, 0), min(stop + pad_width, height)
+    while True:
+        image = np.array(image_data[top:bottom], dtype=dtype)
+        mask = np.array(mask_data[top:bottom], dtype=bool)
+        holes = mask | np.isnan(image)
+        # the strip's values are read from (and smoothed with) the holes up to pad_width rows away
+        near = slice(max(start - pad_width, 0) - top, min(stop + pad_width, height) - top)
+        if not holes[near].any():
+            return image, mask, top, bottom
+        # a hole is filled in the iteration given by its chessboard distance to valid data. Rows missing from the
+        # strip can only make that depth larger, so the reach computed from it is an upper bound.
+        from scipy.ndimage import distance_transform_cdt
+        depth = distance_transform_cdt(holes, metric='chessboard')[near]
+        if depth.min() < 0:
+            # no valid data in the strip at all
+            reach = 2 * max(bottom - top, 1)
+        else:
+            reach = pad_width * (int(depth.max()) + 1)
+        if (top == 0 or top <= start - reach) and (bottom == height or bottom >= stop + reach):
+            return image, mask, top, bottom
+        top, bottom = max(min(top, start - reach), 0), min(max(bottom, stop + reach), height)
+
+
+def _maskfill_strips(input_image:str, mask:Union[str,np.ndarray], ext:Union[int,str], pad_width:int, operator_func:Callable,
+                     strip_rows:int, smooth:bool = True, output_file:str = None, verbose:bool = False,
+                     dtype:Union[str,np.dtype] = None, stats:FillStats = None, backend:str = 'numpy'):
+    """Fill a 2D fits image strip by strip, reading the image and mask and writing `output_file` one strip at a time.
+
+    A hole filled in iteration d only depends on the data within d * pad_width of it (each iteration reads the
+    windows of +/- pad_width), and d is its chessboard distance to valid data. Each strip of `strip_rows` rows is
+    therefore read with a halo of pad_width * (D + 1) rows above and below it, where D is the largest such depth
+    of the holes within pad_width of the strip (whose values the smoothing reads); if the halo first read is
+    too narrow for the depths found in it, the strip is read again with a wider one. The holes of the strip are
+    then filled and smoothed from exactly the data they are filled from in the whole image, so the output file is
+    identical to that of `maskfill` on the whole image, while the memory use is set by the strip size and the
+    depth of the masks (not their length: a trail across the image only needs a halo of about its width). The unsmoothed image is kept in a temporary file next to the output until
+    it is copied into the second extension. Returns `(None, None)`.
+    """
+    from astropy.io import fits
+    if not input_image.endswith('.fits'):
+        input_image+='.fits'
+    if not output_file.endswith('.fits'):
+        output_file +='.fits'
+    with ExitStack() as files:
+        with _timed(stats, 'read'):
+            # no forced memory map: astropy cannot memory-map scaled data (BZERO, BSCALE or BLANK set), which
+            # the sections read and scale strip by strip
+            hdu = files.enter_context(fits.open(input_image))[ext]
+            image_data = hdu.section
+            if isinstance(mask, str):
+                if not mask.endswith('.fits'):
+                    mask+='.fits'
+                mask_hdu = files.enter_context(fits.open(mask))[ext]
+                mask_data, mask_shape = mask_hdu.section, mask_hdu.shape
+            else:
+                mask_data = np.asarray(mask)
+                mask_shape = mask_data.shape
+            working = _working_dtype(np.asarray(image_data[:1]).dtype, dtype)
+        shape = hdu.shape
+        if len(shape) != 2 or mask_shape != shape:
+            raise ValueError(f'strip_rows requires a 2D image with a mask of the same shape; got {shape} and {mask_shape}.')
+        if stats is not None:
+            stats.info.update(shape=list(shape), dtype=str(working), strip_rows=strip_rows)
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        header = None
         if smooth:
-            header = fits.Header() 
+            header = fits.Header()
             header['EXT0'] = 'Filled Smoothed Image'
             header['EXT1'] = 'Filled Image (no smoothing)'
-            hdu0 = fits.PrimaryHDU(smoothed_output,header=header)
-            hdu1 = fits.ImageHDU(output1)
-            hdul = fits.HDUList([hdu0,hdu1])
-            hdul.writeto(output_file,overwrite=True)
-        else:
-            hdu = fits.PrimaryHDU(output1)
-            hdu.writeto(output_file,overwrite=True)
-        if verbose:
-            print(f'Output written to: {output_file}')
+            temp_dir = files.enter_context(tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file))))
+            unsmoothed = np.memmap(os.path.join(temp_dir, 'unsmoothed.dat'), dtype=working, mode='w+', shape=shape)
+        output = _streaming_hdu(output_file, shape, dtype if dtype is not None else working, header)
+        for start in range(0, shape[0], strip_rows):
+            stop = min(start + strip_rows, shape[0])
+            with _timed(stats, 'read'):
+                image, strip_mask, top, bottom = _read_strip(image_data, mask_data, start, stop, pad_width, working)
+            if verbose:
+                print(f'Strip | rows {start}-{stop - 1}, read with rows {top}-{bottom - 1}')
+            if stats is not None:
+                stats.add_count('strips', 1)
+                stats.add_count('halo_rows', (bottom - top) - (stop - start))
+            core = slice(start - top, stop - top)
+            with _timed(stats, 'fill'):
+                # a strip is filled as a whole: split into regions, the masks of a crowded strip give
+                # thousands of small regions whose overhead exceeds the cost of filling them
+                image[strip_mask] = np.nan
+                _iterative_fill(image, pad_width, operator_func, verbose=verbose, stats=stats, label=f'strip {start}-{stop - 1}',
+                                backend=backend)
+            if smooth:
+                unsmoothed[start:stop] = image[core]
+                # only the strip's own masked pixels; those in the halo are smoothed with their own strip
+                smooth_mask = np.zeros_like(strip_mask)
+                smooth_mask[core] = strip_mask[core]
+                with _timed(stats, 'smooth'):
+                    _smooth_in_place(image, smooth_mask, pad_width, backend=backend)
+            with _timed(stats, 'write'):
+                output.write(_cast_output(image[core], dtype))
+        output.close()
+        if smooth:
+            with _timed(stats, 'write'):
+                unsmoothed.flush()
+                _stream_hdu(output_file, unsmoothed, dtype=dtype)
+            del unsmoothed
+    if verbose:
+        print(f'Output written to: {output_file}')
+    return None, None
+
+
+def _filled_header(header:'fits.Header'):
+    """Copy of an input header suitable for the (floating point) filled data."""
+    header = header.copy()
+    for keyword in ['BSCALE', 'BZERO', 'BLANK']:
+        header.remove(keyword, ignore_missing=True)
+    return header
+
+
+def _maskfill_extensions(input_image:str, mask:Union[str,np.ndarray], ext:Union[str,list], pad_width:int, operator_func:Callable,
+                         smooth:bool = True, output_file:str = None, verbose:bool = False, n_jobs:int = 1,
+                         dtype:Union[str,np.dtype] = None, stats:FillStats = None, method:str = 'iterative',
+                         backend:str = 'numpy', max_iterations:int = None, max_distance:float = None, fill_nans:bool = True):
+    """Fill several extensions of a fits file, reading the image (and mask) file only once.
+
+    Returns lists with one entry per extension, in the order `maskfill` returns single outputs.
+    """
+    from astropy.io import fits
+    if not isinstance(input_image, str):
+        raise ValueError('A list of extensions or "all" requires the input image to be a fits file.')
+    if not input_image.endswith('.fits'):
+        input_image+='.fits'
+    with fits.open(input_image) as hdul:
+        with _timed(stats, 'read'):
+            if ext == 'all':
+                ext = [i for i, hdu in enumerate(hdul) if hdu.is_image and hdu.header.get('NAXIS', 0) > 0]
+            indices = [hdul.index_of(e) for e in ext]
+            images = [hdul[i].data for i in indices]
+            if isinstance(mask, str):
+                if not mask.endswith('.fits'):
+                    mask+='.fits'
+                with fits.open(mask) as mask_hdul:
+                    mask_indices = [i for i, hdu in enumerate(mask_hdul) if hdu.is_image and hdu.header.get('NAXIS', 0) > 0]
+                    # a mask file with a single image is shared by all extensions
+                    masks = [np.array(mask_hdul[mask_indices[0] if len(mask_indices) == 1 else i].data, dtype=bool) for i in indices]
+            else:
+                masks = [np.array(mask, dtype=bool)] * len(indices)
+        if stats is not None:
+            stats.info.update(extensions=indices, shape=[list(image.shape) for image in images],
+                              masked_pixels=[int(np.count_nonzero(m)) for m in masks])
+        # extensions are independent; parallelize over them rather than within each
+        results = _map_jobs(lambda j: _maskfill_array(images[j], masks[j], pad_width, operator_func, smooth=smooth, verbose=verbose, dtype=dtype,
+                                                      stats=stats, label=f'ext {indices[j]}, ', method=method, backend=backend,
+                                                      max_iterations=max_iterations, max_distance=max_distance, fill_nans=fill_nans),
+                            range(len(indices)), n_jobs)
+        if output_file is not None:
+            if not output_file.endswith('.fits'):
+                output_file +='.fits'
+            filled = dict(zip(indices, results))
+            hdus = []
+            for i, hdu in enumerate(hdul):
+                if i in filled:
+                    hdu_class = fits.PrimaryHDU if i == 0 else fits.ImageHDU
+                    hdus.append(hdu_class(filled[i][0], header=_filled_header(hdu.header)))
+                else:
+                    hdus.append(hdu)
+            if smooth:
+                for i in indices:
+                    header = _filled_header(hdul[i].header)
+                    header['EXTNAME'] = f'{hdul[i].name if hdul[i].name else f"EXT{i}"}_NOSMOOTH'
+                    hdus.append(fits.ImageHDU(filled[i][1], header=header))
+            with _timed(stats, 'write'):
+                fits.HDUList(hdus).writeto(output_file, overwrite=True)
+            if verbose:
+                print(f'Output written to: {output_file}')
     if smooth:
-        return smoothed_output, output1
-    else:
-        return output1,None
-
-
-def cli():
-    parser = argparse.ArgumentParser()
-    # Define command line arguments
-    parser.add_argument("input", help="input image", type=str)
-    parser.add_argument("mask", help="mask image, with values 0 = good, 1 = bad", type=str)
-    parser.add_argument("output", help="output image", type=str)
-    parser.add_argument("-e", "--extension",help="fits extension of data",type=int)
-    parser.add_argument("-v", "--verbose", help="print actions", action="store_true")
-    parser.add_argument("-s", "--size", help="scale of median filter (default = 3)", type=int)
-    parser.add_argument("-o", "--operator", help="replace pixels with mean or median (default = median)", type=str)
-    parser.add_argument("-n", "--nosmooth", help="omit boxcar smoothing at the end (default = False)", action="store_true")
-    parser.add_argument("-w", "--writesteps", help="write result after each iteration, as _iter_#.fits", action="store_true")
-    args = parser.parse_args()
-    ext = args.extension if args.extension else 0 
-    size = args.size if args.size and args.size>2 else 3
-    operator = args.operator if args.operator and args.operator in ['mean','median'] else 'median'
-    #nosmooth = args.nosmooth if args.nosmooth else False 
-    smooth = not args.nosmooth
-    print(smooth)
-    writesteps = args.writesteps if args.writesteps else False
-    output_file = args.output
-    verbose = args.verbose if args.verbose else False
-    result1, result2 = maskfill(input_image=args.input,
-                                mask = args.mask,
-                                ext = ext,
-                                size=size,
-                                operator=operator,
-                                smooth=smooth,
-                                writesteps=writesteps,
-                                output_file=output_file,
-                                verbose = verbose)
-    
-    
-
-__version__ = "1.1.1"
+        return [result[0] for result in results], [result[1] for result in results]
+    return [result[0] for result in results], None
+
+
+class MaskFiller:
+    """Fill many images that share one mask, with the fill schedule computed only once.
+
+    Without NaNs in the images, which pixels are filled in which iteration depends only on the mask.
+    A `MaskFiller` works this schedule out when it is created (together with the window indices of every
+    pixel of every iteration), so that filling an image reduces to gathering and reducing its windows.
+    The results are identical to `maskfill(image, mask, size=size, operator=operator, smooth=smooth, dtype=dtype)`.
+    An image with NaNs outside the mask needs a schedule of its own and is passed on to `maskfill`.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        2D mask [0 = good, 1 = bad/fill location]; NaNs are treated as 0
+    size : int, optional
+        size of the filter (must be odd), by default 3
+    operator : str, optional
+        fill operator either 'median' or 'mean', by default 'median'
+    smooth : bool, optional
+        whether to boxcar smooth the filled pixels after filling, by default True
+    dtype : Union[str,np.dtype], optional
+        dtype of the returned images (see `maskfill`), by default None
+
+    Examples
+    --------
+    >>> filler = MaskFiller(bad_pixels)
+    >>> for image in images:
+    ...     smoothed, filled = filler.fill(image)
+    """
+    def __init__(self, mask:np.ndarray, size:int = 3, operator:str = 'median', smooth:bool = True,
+                 dtype:Union[str,np.dtype] = None):
+        if operator not in ('median', 'mean'):
+            raise ValueError('Operator must be mean or median.')
+        if size % 2 == 0:
+            raise ValueError("Window_size must be odd")
+        mask = np.array(mask)
+        if mask.ndim != 2:
+            raise ValueError(f'The mask must be 2D; got shape {mask.shape}.')
+        self.mask = np.nan_to_num(mask).astype(bool)
+        self.size = size
+        self.operator = operator
+        self.smooth = smooth
+        self.dtype = dtype
+        self._unmasked = ~self.mask
+        self._window_operator = _WINDOW_OPERATORS[np.nanmedian if operator == 'median' else np.nanmean]
+        self.schedule = self._plan()
+
+    def _plan(self):
+        """Per iteration, the (rows, cols) filled and the window indices of each chunk of them (see `_window_indices`)."""
+        pad_width = self.size // 2
+        chunk = max(1, _CHUNK_ELEMENTS // self.size**2)
+        nan_mask = self.mask.copy()
+        schedule = []
+        rows, cols = _initial_frontier(nan_mask)
+        while rows.size:
+            windows = [_window_indices(self.mask.shape, rows[start:start + chunk], cols[start:start + chunk], pad_width)
+                       for start in range(0, rows.size, chunk)]
+            schedule.append((rows, cols, windows))
+            nan_mask[rows, cols] = False
+            rows, cols = _next_frontier(nan_mask, rows, cols)
+        # mask pixels without any valid pixel to be filled from stay NaN, as in `maskfill`
+        self.unfilled = int(np.count_nonzero(nan_mask))
+        return schedule
+
+    @property
+    def iterations(self):
+        """Number of fill iterations."""
+        return len(self.schedule)
+
+    def _fill_plane(self, output:np.ndarray):
+        """Fill a 2D image in place by replaying the schedule."""
+        output[self.mask] = np.nan
+        for rows, cols, windows in self.schedule:
+            output[rows, cols] = np.concatenate([self._window_operator(_take_windows(output, *plan)) for plan in windows])
+
+    def fill(self, image:np.ndarray):
+        """Fill the masked pixels of `image` (2D, or a cube whose planes are each filled with the mask).
+
+        Parameters
+        ----------
+        image : np.ndarray
+            image of the shape of the mask, or a cube of such images
+
+        Returns
+        -------
+        output1, output2: np.ndarray, np.ndarray
+            as `maskfill`: `smoothed_output, output` if smoothing is on, else `output, None`
+        """
+        image = np.asarray(image)
+        if image.shape[-2:] != self.mask.shape or image.ndim not in (2, 3):
+            raise ValueError(f'Image of shape {image.shape} does not match the mask of shape {self.mask.shape}.')
+        if np.isnan(image, where=self._unmasked, out=np.zeros(image.shape, dtype=bool)).any():
+            # NaNs outside the mask change the schedule
+            return maskfill(image, np.broadcast_to(self.mask, image.shape), size=self.size, operator=self.operator,
+                            smooth=self.smooth, dtype=self.dtype)
+        output = np.array(image, dtype=_working_dtype(image.dtype, self.dtype))
+        for plane in ([output] if output.ndim == 2 else output):
+            self._fill_plane(plane)
+        if not self.smooth:
+            return _cast_output(output, self.dtype), None
+        output1 = np.copy(output)
+        _smooth_in_place(output, np.broadcast_to(self.mask, output.shape), self.size // 2)
+        return _cast_output(output, self.dtype), _cast_output(output1, self.dtype)
+
+
+def _cache_summary(cache:ResultCache):
+    """One line with the hits and misses of `cache` and its size."""
+    return f'Cache: {cache.hits} hits, {cache.misses} misses ({cache.nbytes / 2**20:.1f} MB in {cache.directory}).'
+
+
+def _unfilled_summary(stats:FillStats):
+    """One line with the number of pixels left unfilled, by reason (see `FillStats.unfilled`), or None if there are none."""
+    unfilled = {reason: n for reason, n in stats.unfilled().items() if n}
+    if not unfilled:
+        return None
+    return f'{sum(unfilled.values())} pixels left unfilled (NaN): ' + ', '.join(f'{n} {reason}' for reason, n in unfilled.items()) + '.'
+
+
+# the command line tool, see `maskfill.command_line`
+from .command_line import maskfill_cli as cli
+
 if __name__ == "__main__":
     cli()
-        
-
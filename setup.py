@@ -11,14 +11,19 @@ setup(
     url='https://github.com/dokkum/maskfill',  
     download_url = 'https://github.com/dokkum/maskfill/archive/refs/tags/v1.1.1.tar.gz',
     packages=find_packages(),
+    python_requires='>=3.7',
     install_requires=[
         'numpy',
         'astropy',  
         'scipy'
     ],
+    extras_require={
+        'numba': ['numba'],
+    },
     entry_points={
         'console_scripts': [
-            'maskfill=maskfill.maskfill:cli',
+            'maskfill=maskfill.command_line:maskfill_cli',
+            'maskfill-batch=maskfill.command_line:batch_cli',
         ],
     },
     classifiers=[
@@ -2,6 +2,10 @@
 from maskfill import find_nan_indices, process_masked_pixels, maskfill 
 import numpy as np 
 from astropy.io import fits 
+import importlib
+import subprocess
+import sys
+from pathlib import Path
 # Test Suite for the maskfill code to ensure behavior is as expected. 
 
 
@@ -133,6 +137,23 @@ def test_nanfinder_6():
     out_ind = find_nan_indices(input_array)
     np.testing.assert_equal(out_ind,expected)
 
+def test_nanfinder_7():
+    """
+    NaNs in part of a larger image, including at its edges, are found as by checking each window directly.
+    """
+    rng = np.random.default_rng(7)
+    for window_size in [1, 3, 5, 9]:
+        input_array = rng.normal(size=(30, 40))
+        input_array[18:, 25:][rng.random((12, 15)) < 0.7] = np.nan
+        input_array[0, 3] = np.nan
+        half = window_size // 2
+        padded = np.pad(input_array, half, constant_values=np.nan)
+        expected = [[y, x] for y, x in np.argwhere(np.isnan(input_array))
+                    if (~np.isnan(padded[y:y + window_size, x:x + window_size])).any()]
+        out_ind = find_nan_indices(input_array, window_size=window_size)
+        np.testing.assert_equal(out_ind, np.array(expected, dtype=int).reshape(-1, 2))
+    assert find_nan_indices(np.ones((4, 4))).shape == (0, 2)
+
 
 
 def test_proccess_1(): 
@@ -224,3 +245,659 @@ def test_maskfill_1():
     np.testing.assert_equal(orig,new_sm)
 
 
+
+def test_process_vectorized_mean():
+    """
+    The array-based np.nanmean path must match applying np.nanmean window by window,
+    including windows that run off the edge of the image.
+    """
+    rng = np.random.default_rng(42)
+    input_array = rng.normal(size=(40,50)).astype(np.float32)
+    input_array[rng.random(input_array.shape) < 0.3] = np.nan
+    mask = rng.random(input_array.shape) < 0.2
+    for pad_width in [1,2,3]:
+        for m in [None, mask]:
+            expected = process_masked_pixels(np.copy(input_array),pad_width=pad_width,mask=m,operator_func=lambda w: np.nanmean(w))
+            out = process_masked_pixels(np.copy(input_array),pad_width=pad_width,mask=m,operator_func=np.nanmean)
+            np.testing.assert_array_equal(out,expected)
+
+def test_smooth_values():
+    """
+    The smoothing pass, with its shortcut for windows without NaNs, must match np.nanmean window by window.
+    """
+    mf = importlib.import_module('maskfill.maskfill')
+    rng = np.random.default_rng(3)
+    for dtype in [np.float32, np.float64]:
+        input_array = rng.lognormal(size=(40,50)).astype(dtype)
+        input_array[rng.random(input_array.shape) < 0.01] = np.nan
+        mask = rng.random(input_array.shape) < 0.3
+        for pad_width in [1,3]:
+            expected = process_masked_pixels(np.copy(input_array),pad_width=pad_width,mask=mask,operator_func=lambda w: np.nanmean(w))
+            out = np.copy(input_array)
+            mf._smooth_in_place(out, mask, pad_width)
+            np.testing.assert_array_equal(out,expected)
+
+def test_process_vectorized_median(monkeypatch):
+    """
+    The batched np.nanmedian path must be bit-identical to np.nanmedian per window (even and odd
+    counts of finite neighbors), also when the windows are processed in many small chunks.
+    """
+    mf = importlib.import_module('maskfill.maskfill')
+    rng = np.random.default_rng(7)
+    input_array = rng.normal(size=(40,50)).astype(np.float32)
+    input_array[rng.random(input_array.shape) < 0.4] = np.nan
+    mask = rng.random(input_array.shape) < 0.2
+    for chunk_elements in [mf._CHUNK_ELEMENTS, 50]:
+        monkeypatch.setattr(mf, '_CHUNK_ELEMENTS', chunk_elements)
+        for pad_width in [1,2,4]:
+            for m in [None, mask]:
+                expected = process_masked_pixels(np.copy(input_array),pad_width=pad_width,mask=m,operator_func=lambda w: np.nanmedian(w))
+                out = process_masked_pixels(np.copy(input_array),pad_width=pad_width,mask=m,operator_func=np.nanmedian)
+                np.testing.assert_array_equal(out,expected)
+
+def _reference_fill(input_array, mask, size, operator_func):
+    """
+    Fill layer by layer with full rescans of the image, as maskfill originally did.
+    """
+    output = np.copy(input_array)
+    output[mask] = np.nan
+    while np.isnan(output).any():
+        output = process_masked_pixels(output,pad_width=size//2,operator_func=operator_func)
+    return output
+
+
+def test_maskfill_frontier_tracking():
+    """
+    Tracking the frontier between iterations must reproduce the full-rescan iteration exactly,
+    for holes touching the border, pre-existing NaNs outside the mask, and larger windows.
+    """
+    rng = np.random.default_rng(3)
+    input_array = rng.normal(size=(60,70)).astype(np.float32)
+    input_array[20:25, 30:40] = np.nan
+    mask = np.zeros(input_array.shape, dtype=bool)
+    mask[0:12, 0:9] = True
+    mask[30:52, 40:61] = True
+    mask[rng.random(mask.shape) < 0.05] = True
+    for size in [3,5]:
+        for operator, operator_func in [('median', np.nanmedian), ('mean', np.nanmean)]:
+            expected = _reference_fill(input_array, mask, size, operator_func)
+            out, _ = maskfill(input_array, mask, size=size, operator=operator, smooth=False)
+            np.testing.assert_array_equal(out, expected)
+
+def test_maskfill_regions():
+    """
+    Filling separate regions on their own must equal whole-image filling, including regions
+    whose fill windows just touch (spacing of size//2 pixels) or just miss each other.
+    """
+    rng = np.random.default_rng(11)
+    input_array = rng.normal(size=(80,90)).astype(np.float32)
+    for size in [3,5,7]:
+        pad_width = size // 2
+        mask = np.zeros(input_array.shape, dtype=bool)
+        mask[10:20, 10:20] = True
+        mask[19 + pad_width:30, 15:25] = True   # rows just within reach of the first block
+        mask[10:20, 20 + pad_width:30] = True   # columns just out of reach
+        mask[50:75, 5:8] = True
+        mask[40:45, 60:90] = True               # touches the border
+        mask[60, 70] = True
+        for operator, operator_func in [('median', np.nanmedian), ('mean', np.nanmean)]:
+            expected = _reference_fill(input_array, mask, size, operator_func)
+            out, _ = maskfill(input_array, mask, size=size, operator=operator, smooth=False)
+            np.testing.assert_array_equal(out, expected)
+
+def test_maskfill_parallel():
+    """
+    Filling the separate regions on several threads must give exactly the serial result.
+    """
+    rng = np.random.default_rng(5)
+    input_array = rng.normal(size=(120,130)).astype(np.float32)
+    mask = np.zeros(input_array.shape, dtype=bool)
+    for y, x in rng.integers(0, 110, size=(25,2)):
+        mask[y:y+rng.integers(1,10), x:x+rng.integers(1,10)] = True
+    serial_sm, serial = maskfill(input_array, mask)
+    for n_jobs in [4, -1]:
+        parallel_sm, parallel = maskfill(input_array, mask, n_jobs=n_jobs)
+        np.testing.assert_array_equal(parallel_sm, serial_sm)
+        np.testing.assert_array_equal(parallel, serial)
+
+def test_batch(tmp_path):
+    """
+    A batch run fills every frame like a single maskfill call and carries on past a failing frame.
+    """
+    from maskfill import find_batch_jobs, run_batch
+    im = fits.getdata('../example_synthetic/synth_im.fits')
+    (tmp_path / 'raw').mkdir()
+    for name in ['a.fits', 'b.fits']:
+        fits.writeto(tmp_path / 'raw' / name, im)
+    (tmp_path / 'raw' / 'c.fits').write_text('not a fits file')
+    jobs = find_batch_jobs(input_dir=str(tmp_path / 'raw'),
+                           mask='../example_synthetic/synth_mask.fits',
+                           output_dir=str(tmp_path))
+    assert [job[0] for job in jobs] == [str(tmp_path / 'raw' / name) for name in ['a.fits', 'b.fits', 'c.fits']]
+    records = run_batch(jobs, n_jobs=2)
+    assert [record['error'] is None for record in records] == [True, True, False]
+    expected = fits.getdata('default.fits')
+    for name in ['a.fits', 'b.fits']:
+        np.testing.assert_equal(fits.getdata(tmp_path / name), expected)
+
+    # the pipelined run (reading, filling and writing overlapped) writes the same files
+    (tmp_path / 'pipelined').mkdir()
+    pipelined_jobs = [(i, m, str(tmp_path / "pipelined" / Path(o).name)) for i, m, o in jobs]
+    for n_jobs in [1, 2]:
+        records = run_batch(pipelined_jobs, n_jobs=n_jobs, queue_depth=1, profile=True, progress=False)
+        assert [record['input'] for record in records] == [job[0] for job in jobs]
+        assert [record['error'] is None for record in records] == [True, True, False]
+        assert records[0]['profile']['timings']['write'] > 0
+        for name in ['a.fits', 'b.fits']:
+            np.testing.assert_equal(fits.getdata(tmp_path / 'pipelined' / name), expected)
+            np.testing.assert_equal(fits.getdata(tmp_path / 'pipelined' / name, 1), fits.getdata(tmp_path / name, 1))
+
+    manifest = tmp_path / 'frames.txt'
+    manifest.write_text(f'# input mask output\n{jobs[0][0]} {jobs[0][1]} {tmp_path / "m.fits"}\n')
+    assert find_batch_jobs(manifest=str(manifest)) == [(jobs[0][0], jobs[0][1], str(tmp_path / 'm.fits'))]
+
+def test_maskfill_cube():
+    """
+    A cube is filled plane by plane, with either a cube or a shared 2D mask. Nested lists are
+    filled as the arrays they hold.
+    """
+    rng = np.random.default_rng(8)
+    cube = rng.normal(size=(3,40,50)).astype(np.float32)
+    mask = np.zeros(cube.shape, dtype=bool)
+    mask[0, 5:15, 5:15] = True
+    mask[1, 20:30, 30:45] = True
+    mask[2, :, 10:12] = True
+    out_sm, out = maskfill(cube, mask, n_jobs=2)
+    out_sm2, _ = maskfill(cube, mask[1])
+    for plane in range(3):
+        expected_sm, expected = maskfill(cube[plane], mask[plane])
+        np.testing.assert_array_equal(out_sm[plane], expected_sm)
+        np.testing.assert_array_equal(out[plane], expected)
+        np.testing.assert_array_equal(out_sm2[plane], maskfill(cube[plane], mask[1])[0])
+    # lists of python floats are float64
+    np.testing.assert_array_equal(maskfill(cube.tolist(), mask.tolist())[0], maskfill(cube.astype(np.float64), mask)[0])
+    np.testing.assert_array_equal(maskfill(cube[0].tolist(), mask[0].tolist())[0], maskfill(cube[0].astype(np.float64), mask[0])[0])
+
+
+def test_maskfill_extensions(tmp_path, monkeypatch):
+    """
+    Filling 'all' extensions of a multi-extension file gives the single-extension results,
+    keeps the headers and structure of the file, and appends the unsmoothed versions.
+    """
+    im = fits.getdata('../example_synthetic/synth_im.fits')
+    mask = fits.getdata('../example_synthetic/synth_mask.fits')
+    primary = fits.PrimaryHDU()
+    primary.header['OBSERVER'] = 'maskfill'
+    hdul = fits.HDUList([primary,
+                         fits.ImageHDU(im, name='CCD1'),
+                         fits.ImageHDU(im[::-1], name='CCD2')])
+    hdul[2].header['GAIN'] = 1.5
+    hdul.writeto(tmp_path / 'mef.fits')
+    out_sm, out = maskfill(str(tmp_path / 'mef.fits'), '../example_synthetic/synth_mask.fits', ext='all',
+                           output_file=str(tmp_path / 'out.fits'), n_jobs=2)
+    for i, data in enumerate([im, im[::-1]]):
+        expected_sm, expected = maskfill(data, mask)
+        np.testing.assert_array_equal(out_sm[i], expected_sm)
+        np.testing.assert_array_equal(out[i], expected)
+    with fits.open(tmp_path / 'out.fits') as result:
+        assert [hdu.name for hdu in result] == ['PRIMARY', 'CCD1', 'CCD2', 'CCD1_NOSMOOTH', 'CCD2_NOSMOOTH']
+        assert result[0].header['OBSERVER'] == 'maskfill'
+        assert result['CCD2'].header['GAIN'] == 1.5
+        np.testing.assert_array_equal(result['CCD1'].data, out_sm[0])
+        np.testing.assert_array_equal(result['CCD2_NOSMOOTH'].data, out[1])
+    out_sm, _ = maskfill(str(tmp_path / 'mef.fits'), mask, ext=[2], smooth=True)
+    assert len(out_sm) == 1
+    np.testing.assert_array_equal(out_sm[0], maskfill(im[::-1], mask)[0])
+
+    # the command line tools (which do not keep the unsmoothed images) fill extension lists too
+    from maskfill import run_batch
+    from maskfill.command_line import maskfill_cli
+    records = run_batch([(str(tmp_path / 'mef.fits'), '../example_synthetic/synth_mask.fits', str(tmp_path / 'batch.fits'))],
+                        ext='all', progress=False)
+    assert records[0]['error'] is None
+    monkeypatch.setattr(sys, 'argv', ['maskfill', str(tmp_path / 'mef.fits'), '../example_synthetic/synth_mask.fits',
+                                      str(tmp_path / 'cli.fits'), '-e', '1,2'])
+    maskfill_cli()
+    for name in ['batch.fits', 'cli.fits']:
+        with fits.open(tmp_path / name) as result:
+            assert [hdu.name for hdu in result] == ['PRIMARY', 'CCD1', 'CCD2', 'CCD1_NOSMOOTH', 'CCD2_NOSMOOTH']
+            np.testing.assert_array_equal(result['CCD2'].data, maskfill(im[::-1], mask)[0])
+
+def test_maskfill_low_memory(tmp_path):
+    """
+    The low-memory path (memory-mapped input filled in place, streamed output) and filling into a
+    preallocated or the input buffer give the same images and output file as the default path.
+    """
+    expected_sm, expected = maskfill('../example_synthetic/synth_im.fits', '../example_synthetic/synth_mask.fits',
+                                     output_file=str(tmp_path / 'default.fits'))
+    out_sm, out = maskfill('../example_synthetic/synth_im.fits', '../example_synthetic/synth_mask.fits',
+                           output_file=str(tmp_path / 'lowmem.fits'), low_memory=True)
+    assert out is None
+    np.testing.assert_array_equal(out_sm, expected_sm)
+    with fits.open(tmp_path / 'default.fits') as default, fits.open(tmp_path / 'lowmem.fits') as lowmem:
+        assert len(lowmem) == 2
+        assert lowmem[0].header['EXT1'] == default[0].header['EXT1']
+        for hdu, expected_hdu in zip(lowmem, default):
+            np.testing.assert_array_equal(hdu.data, expected_hdu.data)
+    out, _ = maskfill('../example_synthetic/synth_im.fits', '../example_synthetic/synth_mask.fits', smooth=False,
+                      output_file=str(tmp_path / 'nosmooth.fits'), low_memory=True)
+    np.testing.assert_array_equal(fits.getdata(tmp_path / 'nosmooth.fits'), expected)
+
+    im = fits.getdata('../example_synthetic/synth_im.fits').astype(np.float32)
+    mask = fits.getdata('../example_synthetic/synth_mask.fits')
+    buffer = np.empty_like(im)
+    out_sm, _ = maskfill(im, mask, out=buffer)
+    assert out_sm is buffer
+    np.testing.assert_array_equal(buffer, expected_sm)
+    out_sm, _ = maskfill(im, mask, out=im, low_memory=True)
+    assert out_sm is im
+    np.testing.assert_array_equal(im, expected_sm)
+
+def test_maskfill_dtype(tmp_path):
+    """
+    float32 images stay float32 through the fill, the smoothing and the output file; integer images are
+    promoted once and can be returned in a requested dtype.
+    """
+    im = fits.getdata('../example_synthetic/synth_im.fits')
+    mask = fits.getdata('../example_synthetic/synth_mask.fits')
+    out_sm, out = maskfill(im.astype(np.float32), mask, output_file=str(tmp_path / 'out.fits'))
+    assert out_sm.dtype == np.float32 and out.dtype == np.float32
+    assert fits.getdata(tmp_path / 'out.fits').dtype.name == 'float32'
+    np.testing.assert_array_equal(out_sm, fits.getdata('default.fits'))
+    out_sm, _ = maskfill(im, mask, dtype=np.float64)
+    assert out_sm.dtype == np.float64
+
+    counts = np.round(im * 100).astype(np.int16)
+    out_sm, out = maskfill(counts, mask)
+    assert out_sm.dtype == np.float32
+    np.testing.assert_array_equal(out_sm, maskfill(counts.astype(np.float32), mask)[0])
+    assert maskfill(counts.astype(np.int32), mask)[0].dtype == np.float64
+    out_sm, out = maskfill(counts, mask, dtype=np.int16, output_file=str(tmp_path / 'int.fits'))
+    assert out_sm.dtype == np.int16 and out.dtype == np.int16
+    np.testing.assert_array_equal(out_sm, np.rint(maskfill(counts, mask)[0]))
+    np.testing.assert_array_equal(fits.getdata(tmp_path / 'int.fits'), out_sm)
+    out_sm, _ = maskfill(counts, mask, dtype='int16', low_memory=True, output_file=str(tmp_path / 'int_lowmem.fits'))
+    np.testing.assert_array_equal(fits.getdata(tmp_path / 'int_lowmem.fits'), fits.getdata(tmp_path / 'int.fits'))
+
+    # scaled int16 data (BZERO/BSCALE), which astropy cannot memory-map
+    hdu = fits.PrimaryHDU(im.astype(np.float32))
+    hdu.scale('int16', option='minmax')
+    hdu.writeto(tmp_path / 'scaled.fits')
+    scaled = fits.getdata(tmp_path / 'scaled.fits')
+    expected = maskfill(scaled, mask)
+    for low_memory in [False, True]:
+        out_sm, _ = maskfill(str(tmp_path / 'scaled.fits'), '../example_synthetic/synth_mask.fits', low_memory=low_memory,
+                             output_file=str(tmp_path / 'scaled_out.fits'))
+        np.testing.assert_array_equal(out_sm, expected[0])
+        np.testing.assert_array_equal(fits.getdata(tmp_path / 'scaled_out.fits'), expected[0])
+
+def test_bench():
+    """
+    the benchmark runs every combination of its settings and returns JSON-serializable records.
+    """
+    import json
+    from maskfill.bench import run_benchmark, environment, MASKS
+    for name, make_mask in MASKS.items():
+        mask = make_mask((64, 64), coverage=0.05)
+        assert mask.dtype == bool and 0 < mask.sum() < mask.size
+    records = run_benchmark(shape=(48, 64), masks=['cosmics', 'trails'], coverages=[0.05], sizes=[3],
+                            operators=['median', 'mean'], smooth=[True], methods=['iterative', 'pyramid'], repeat=1, memory=True)
+    assert len(records) == 8
+    assert all(record['seconds'] > 0 and record['peak_memory_mb'] > 0 for record in records)
+    assert all(record['rms_error'] > 0 and record['iterations'] > 0 for record in records)
+    assert all(record['rms_vs_reference'] == 0 for record in records if record['method'] == 'iterative')
+    json.dumps(dict(environment=environment(), results=records))
+
+def test_maskfill_stats(tmp_path):
+    """
+    the instrumentation records every iteration and phase without changing the result.
+    """
+    import json
+    from maskfill import FillStats
+    im = fits.getdata('../example_synthetic/synth_im.fits')
+    mask = fits.getdata('../example_synthetic/synth_mask.fits').astype(bool)
+    records = []
+    stats = FillStats(callback=records.append)
+    out_sm, out = maskfill('../example_synthetic/synth_im.fits', '../example_synthetic/synth_mask.fits',
+                           output_file=str(tmp_path / 'out.fits'), stats=stats)
+    np.testing.assert_array_equal(out_sm, fits.getdata('default.fits'))
+    report = stats.to_dict()
+    assert records == report['iterations'] and report['n_iterations'] == len(records) > 0
+    assert set(report['timings']) == {'total', 'read', 'prepare', 'fill', 'smooth', 'write'}
+    assert report['info']['masked_pixels'] == mask.sum()
+    # every masked (or NaN) pixel is filled exactly once, in the frontier of one iteration
+    assert sum(record['frontier'] for record in records) == (mask | np.isnan(im)).sum()
+    assert all(record['remaining'] >= record['frontier'] for record in records)
+    stats.write(str(tmp_path / 'profile.json'))
+    assert json.load(open(tmp_path / 'profile.json'))['n_iterations'] == len(records)
+
+def test_maskfill_smooth_in_place(tmp_path):
+    """
+    smoothing in place returns the same smoothed image and writes the same output file,
+    without returning (or keeping) the unsmoothed image.
+    """
+    im = fits.getdata('../example_synthetic/synth_im.fits')
+    mask = fits.getdata('../example_synthetic/synth_mask.fits')
+    expected_sm, _ = maskfill(im, mask, output_file=str(tmp_path / 'default.fits'))
+    original = im.copy()
+    out_sm, out = maskfill(im, mask, output_file=str(tmp_path / 'inplace.fits'), keep_unsmoothed=False)
+    assert out is None
+    np.testing.assert_array_equal(out_sm, expected_sm)
+    np.testing.assert_array_equal(im, original)
+    with fits.open(tmp_path / 'default.fits') as default, fits.open(tmp_path / 'inplace.fits') as inplace:
+        assert len(inplace) == len(default) == 2
+        for hdu, expected_hdu in zip(inplace, default):
+            np.testing.assert_array_equal(hdu.data, expected_hdu.data)
+    cube = np.stack([im, im[::-1]])
+    np.testing.assert_array_equal(maskfill(cube, mask, keep_unsmoothed=False)[0], maskfill(cube, mask)[0])
+
+def test_maskfill_pyramid():
+    """
+    the pyramid method fills large holes in far fewer iterations, close to the iterative result,
+    and is identical to it for masks too thin to need a coarser level.
+    """
+    from maskfill import FillStats
+    rng = np.random.default_rng(5)
+    y, x = np.mgrid[0:200, 0:240]
+    im = (np.sin(x / 30) + np.cos(y / 25) + rng.normal(0, 0.05, x.shape)).astype(np.float32)
+    hole = (y - 90)**2 + (x - 130)**2 < 60**2
+    stats = {method: FillStats() for method in ['iterative', 'pyramid']}
+    filled = {method: maskfill(im, hole, method=method, stats=stats[method])[0] for method in stats}
+    assert not np.isnan(filled['pyramid']).any()
+    np.testing.assert_array_equal(filled['pyramid'][~hole], im[~hole])
+    assert len(stats['pyramid'].iterations) < len(stats['iterative'].iterations) / 3
+    assert np.sqrt(np.mean((filled['pyramid'][hole] - im[hole])**2)) < np.sqrt(np.mean((filled['iterative'][hole] - im[hole])**2)) * 1.5
+    im = fits.getdata('../example_synthetic/synth_im.fits')
+    mask = fits.getdata('../example_synthetic/synth_mask.fits')
+    thin = mask * (rng.random(mask.shape) < 0.2)
+    np.testing.assert_array_equal(maskfill(im, thin, method='pyramid')[0], maskfill(im, thin)[0])
+
+def test_maskfill_distance():
+    """
+    the distance method orders the masked pixels by their exact Euclidean distance to valid data, fills
+    them all, stays close to the iterative result, and gives the same result with every backend.
+    """
+    from scipy.ndimage import distance_transform_edt
+    mf = importlib.import_module('maskfill.maskfill')
+    rng = np.random.default_rng(6)
+    for _ in range(50):
+        holes = rng.random(rng.integers(1, 30, 2)) < rng.uniform(0.2, 0.95)
+        if holes.all() or not holes.any():
+            continue
+        rows, cols = np.nonzero(holes)
+        np.testing.assert_array_equal(mf._squared_distances(holes, rows, cols), np.round(distance_transform_edt(holes)[rows, cols]**2))
+    im = fits.getdata('../example_m51/m51_with_cosmicrays.fits').astype(np.float32)
+    org = fits.getdata('../example_m51/m51_org.fits')
+    mask = fits.getdata('../example_m51/m51_mask.fits').astype(bool)
+    filled = maskfill(im, mask, method='distance')[0]
+    assert not np.isnan(filled).any()
+    np.testing.assert_array_equal(filled[~mask], im[~mask])
+    rms = {method: np.sqrt(np.mean((maskfill(im, mask, method=method)[0][mask] - org[mask])**2)) for method in ['iterative', 'distance']}
+    assert rms['distance'] < rms['iterative'] * 1.05
+    for backend in ['python', 'numba']:
+        np.testing.assert_array_equal(maskfill(im[:100, :100], mask[:100, :100], method='distance', backend=backend)[0],
+                                      maskfill(im[:100, :100], mask[:100, :100], method='distance')[0])
+
+def test_maskfill_cache(tmp_path):
+    """
+    a cached result is returned (memory-mapped) for the same image, mask and settings, and only for those;
+    the least recently used results are evicted beyond the size limit.
+    """
+    from maskfill import ResultCache, FillStats
+    im = fits.getdata('../example_synthetic/synth_im.fits')
+    mask = fits.getdata('../example_synthetic/synth_mask.fits')
+    expected = maskfill(im, mask)
+    cache = ResultCache(str(tmp_path / 'cache'))
+    first = maskfill(im, mask, cache=cache)
+    stats = FillStats()
+    second = maskfill(im, mask, cache=cache, stats=stats, output_file=str(tmp_path / 'out.fits'))
+    assert (cache.hits, cache.misses) == (1, 1) and stats.counts == dict(cache_hits=1)
+    assert isinstance(second[0], np.memmap) and not second[0].flags.writeable
+    for result in [first, second]:
+        np.testing.assert_array_equal(result[0], expected[0])
+        np.testing.assert_array_equal(result[1], expected[1])
+    np.testing.assert_array_equal(fits.getdata(tmp_path / 'out.fits'), expected[0])
+    assert maskfill(im, mask, cache=str(tmp_path / 'cache'), keep_unsmoothed=False)[1] is None
+    changed = im.copy()
+    changed[0, 0] += 1
+    for args, kwargs in [((changed, mask), {}), ((im, mask), dict(size=5)), ((im, mask), dict(smooth=False)), ((im, mask), dict(dtype='float64'))]:
+        np.testing.assert_array_equal(maskfill(*args, cache=cache, **kwargs)[0], maskfill(*args, **kwargs)[0])
+    assert (cache.hits, cache.misses) == (1, 5)
+    cache.evict(max_bytes=cache.nbytes - 1)
+    assert len(list((tmp_path / 'cache').iterdir())) == 4
+    # the first entry was used last before the others were added, so it was the one removed
+    maskfill(im, mask, cache=cache)
+    assert cache.misses == 6
+
+def test_maskfill_limits():
+    """
+    max_iterations, max_distance and fill_nans=False leave pixels NaN (unsmoothed), fill the others as the
+    unlimited fill does (for max_iterations), and count the pixels left unfilled by reason.
+    """
+    from maskfill import FillStats
+    from scipy.ndimage import distance_transform_edt
+    im = fits.getdata('../example_synthetic/synth_im.fits').astype(np.float32)
+    mask = fits.getdata('../example_synthetic/synth_mask.fits').astype(bool)
+    im[:5, :5] = np.nan
+    full = maskfill(im, mask)[1]
+    for method in ['iterative', 'distance']:
+        stats = FillStats()
+        smoothed, filled = maskfill(im, mask, max_iterations=2, method=method, stats=stats)
+        unfilled = np.isnan(filled)
+        assert unfilled.any() and stats.unfilled() == dict(max_iterations=int(unfilled.sum()))
+        np.testing.assert_array_equal(np.isnan(smoothed), unfilled)
+        if method == 'iterative':
+            np.testing.assert_array_equal(filled[~unfilled], full[~unfilled])
+    holes = mask | np.isnan(im)
+    stats = FillStats()
+    filled = maskfill(im, mask, max_distance=3, stats=stats)[1]
+    np.testing.assert_array_equal(np.isnan(filled), distance_transform_edt(holes) > 3)
+    assert stats.unfilled() == dict(max_distance=int((distance_transform_edt(holes) > 3).sum()))
+    stats = FillStats()
+    filled = maskfill(im, mask, fill_nans=False, stats=stats)[1]
+    np.testing.assert_array_equal(np.isnan(filled), np.isnan(im) & ~mask)
+    assert stats.unfilled() == dict(nan=int((np.isnan(im) & ~mask).sum()))
+    cube = np.stack([im[:64, :64]] * 3)
+    np.testing.assert_array_equal(maskfill(cube, mask[:64, :64], fill_nans=False, max_iterations=1)[1][1],
+                                  maskfill(im[:64, :64], mask[:64, :64], fill_nans=False, max_iterations=1)[1])
+    try:
+        maskfill(im, mask, method='pyramid', max_iterations=2)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('the limits are not supported by the pyramid method, which should raise a ValueError')
+    try:
+        maskfill(im, mask, max_distance=1, dtype='int16')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('unfilled pixels cannot be converted to integers, which should raise a ValueError')
+
+def test_maskfill_steps_file(tmp_path, monkeypatch):
+    """
+    writesteps with a file name records the pixels filled in each iteration in one table, from which
+    the intermediate images written by writesteps=True can be rebuilt.
+    """
+    from maskfill import iteration_map
+    im = fits.getdata('../example_synthetic/synth_im.fits').astype(np.float32)
+    mask = fits.getdata('../example_synthetic/synth_mask.fits').astype(bool)
+    result = maskfill(im, mask, writesteps=str(tmp_path / 'steps'))
+    np.testing.assert_array_equal(result[0], maskfill(im, mask)[0])
+    with fits.open(tmp_path / 'steps.fits') as hdul:
+        steps, n_iterations = hdul['STEPS'].data, hdul[0].header['NITER']
+    iterations = iteration_map(str(tmp_path / 'steps.fits'))
+    np.testing.assert_array_equal(iterations > 0, mask)
+    assert iterations.max() == n_iterations and np.all(np.diff(steps['ITER']) >= 0)
+    np.testing.assert_array_equal(steps['VALUE'], result[1][steps['ROW'], steps['COL']])
+    monkeypatch.chdir(tmp_path)
+    maskfill(im, mask, writesteps=True)
+    image = im.copy()
+    image[mask] = np.nan
+    for k in [1, n_iterations // 2, n_iterations]:
+        done = steps['ITER'] <= k
+        image[steps['ROW'][done], steps['COL'][done]] = steps['VALUE'][done]
+        np.testing.assert_array_equal(image, fits.getdata(tmp_path / f'_iter_{k}.fits'))
+
+def test_mask_filler():
+    """
+    a MaskFiller built once from a mask gives the same results as maskfill for every image,
+    including cubes and images with NaNs outside the mask (which fall back on maskfill).
+    """
+    from maskfill import MaskFiller
+    im = fits.getdata('../example_synthetic/synth_im.fits')
+    mask = fits.getdata('../example_synthetic/synth_mask.fits')
+    filler = MaskFiller(mask)
+    assert filler.iterations > 0 and filler.unfilled == 0
+    out_sm, out = filler.fill(im)
+    np.testing.assert_array_equal(out_sm, fits.getdata('default.fits'))
+    np.testing.assert_array_equal(out, maskfill(im, mask)[1])
+    rng = np.random.default_rng(11)
+    for operator, size, smooth in [('mean', 3, True), ('median', 5, False)]:
+        filler = MaskFiller(mask, size=size, operator=operator, smooth=smooth)
+        for image in [im * 2 + 1, np.stack([im, im[::-1]])]:
+            expected = maskfill(image, mask, size=size, operator=operator, smooth=smooth)
+            result = filler.fill(image)
+            np.testing.assert_array_equal(result[0], expected[0])
+            assert (result[1] is None) == (not smooth)
+    with_nans = im.copy()
+    with_nans[rng.random(im.shape) < 0.01] = np.nan
+    np.testing.assert_array_equal(MaskFiller(mask).fill(with_nans)[0], maskfill(with_nans, mask)[0])
+
+def test_maskfill_stack():
+    """
+    a stack of small frames, each with its own mask, is filled in one pass with the same result
+    as filling every frame on its own; nothing leaks between frames.
+    """
+    rng = np.random.default_rng(2)
+    ims = rng.normal(size=(6, 20, 30)).astype(np.float32)
+    masks = rng.random(ims.shape) < 0.3
+    masks[1, :8] = True
+    masks[2, -1] = True
+    masks[3] = True
+    ims[4, 5, 5] = np.nan
+    for operator, size in [('median', 3), ('mean', 5)]:
+        for n_jobs in [1, 2]:
+            out_sm, out = maskfill(ims, masks, operator=operator, size=size, n_jobs=n_jobs)
+            for plane in range(ims.shape[0]):
+                expected_sm, expected = maskfill(ims[plane], masks[plane], operator=operator, size=size)
+                np.testing.assert_array_equal(out_sm[plane], expected_sm)
+                np.testing.assert_array_equal(out[plane], expected)
+    assert np.isnan(out[3]).all()
+
+def test_maskfill_backends(monkeypatch):
+    """
+    the python, numpy and numba backends give identical results, for images and stacks of frames;
+    without Numba, the numba backend falls back to numpy with a warning. The kernels behind the numba
+    backend also match the numpy engine when run as plain Python, and are used for (big-endian) fits input.
+    """
+    import warnings
+    from maskfill import kernels
+    mf = importlib.import_module('maskfill.maskfill')
+    rng = np.random.default_rng(4)
+    im = fits.getdata('../example_synthetic/synth_im.fits')
+    mask = fits.getdata('../example_synthetic/synth_mask.fits')
+    ims = rng.normal(size=(3, 20, 30)).astype(np.float32)
+    masks = rng.random(ims.shape) < 0.3
+    for image, image_mask in [(im, mask), (ims, masks)]:
+        for operator, size in [('median', 3), ('mean', 3), ('median', 5), ('mean', 7)]:
+            expected = maskfill(image, image_mask, operator=operator, size=size)
+            for backend in ['python', 'numba']:
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter('always')
+                    result = maskfill(image, image_mask, operator=operator, size=size, backend=backend)
+                np.testing.assert_array_equal(result[0], expected[0])
+                np.testing.assert_array_equal(result[1], expected[1])
+                fallback = kernels.compiled_kernels() is None and backend == 'numba'
+                assert any('Numba is not installed' in str(w.message) for w in caught) == fallback
+    image = rng.normal(size=(30, 40)).astype(np.float32)
+    image[rng.random(image.shape) < 0.3] = np.nan
+    rows, cols = np.nonzero(rng.random(image.shape) < 0.2)
+    # up to 13x13 windows, which numpy sums in two pairwise blocks
+    for pad_width in [1, 3, 6]:
+        for name, operator_func in [('nanmean_kernel', np.nanmean), ('nanmedian_kernel', np.nanmedian)]:
+            kernel = getattr(kernels, name)
+            out = np.empty(rows.size, dtype=image.dtype)
+            getattr(kernel, 'py_func', kernel)(image, rows, cols, pad_width, 15, out)
+            np.testing.assert_array_equal(out, mf._numpy_engine(image, rows, cols, pad_width, operator_func, plane_height=15))
+    if kernels.compiled_kernels() is not None:
+        expected = maskfill(im, mask)
+        calls = []
+        numpy_engine = mf._numpy_engine
+        monkeypatch.setattr(mf, '_numpy_engine', lambda *args, **kwargs: calls.append(args) or numpy_engine(*args, **kwargs))
+        result = maskfill('../example_synthetic/synth_im.fits', '../example_synthetic/synth_mask.fits', backend='numba')
+        assert not calls
+        np.testing.assert_array_equal(result[0], expected[0])
+        np.testing.assert_array_equal(result[1], expected[1])
+    try:
+        maskfill(im, mask, backend='fortran')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('an unknown backend should raise a ValueError')
+
+def test_maskfill_strips(tmp_path):
+    """
+    filling a fits image strip by strip, with the halo widened as needed, writes exactly the same
+    output file as filling the whole image, for masks much taller than the strips.
+    """
+    im = fits.getdata('../example_m51/m51_with_cosmicrays.fits')
+    mask = fits.getdata('../example_m51/m51_mask.fits').astype(bool)
+    # a tall mask and a large one, spanning many strips
+    mask[100:400, 250:256] = True
+    mask[300:380, 50:130] = True
+    for size, operator, smooth, strip_rows in [(3, 'median', True, 16), (5, 'mean', True, 7), (3, 'median', False, 200)]:
+        output_file = str(tmp_path / 'strips.fits')
+        expected = maskfill(im, mask, size=size, operator=operator, smooth=smooth)
+        result = maskfill('../example_m51/m51_with_cosmicrays.fits', mask, size=size, operator=operator, smooth=smooth,
+                          output_file=output_file, strip_rows=strip_rows)
+        assert result == (None, None)
+        with fits.open(output_file) as hdul:
+            assert len(hdul) == (2 if smooth else 1)
+            np.testing.assert_array_equal(hdul[0].data, expected[0])
+            if smooth:
+                np.testing.assert_array_equal(hdul[1].data, expected[1])
+    np.testing.assert_array_equal(maskfill('../example_synthetic/synth_im.fits', '../example_synthetic/synth_mask.fits',
+                                           output_file=output_file, strip_rows=10)[0], None)
+    np.testing.assert_array_equal(fits.getdata(output_file), fits.getdata('default.fits'))
+    # scaled int16 data (BZERO/BSCALE), which astropy cannot memory-map
+    hdu = fits.PrimaryHDU(im.astype(np.float32))
+    hdu.scale('int16', option='minmax')
+    hdu.writeto(tmp_path / 'scaled.fits')
+    maskfill(str(tmp_path / 'scaled.fits'), mask, output_file=output_file, strip_rows=16)
+    with fits.open(output_file) as hdul:
+        expected = maskfill(fits.getdata(tmp_path / 'scaled.fits'), mask)
+        np.testing.assert_array_equal(hdul[0].data, expected[0])
+        np.testing.assert_array_equal(hdul[1].data, expected[1])
+    for option in [dict(low_memory=True), dict(n_jobs=2)]:
+        try:
+            maskfill('../example_synthetic/synth_im.fits', '../example_synthetic/synth_mask.fits',
+                     output_file=output_file, strip_rows=10, **option)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f'strip_rows does not support {option}, which should raise a ValueError')
+
+
+def test_lazy_imports():
+    """
+    importing the package and filling arrays does not import astropy or scipy, and the command line
+    tools parse their arguments (e.g. --version) without importing numpy.
+    """
+    code = ('import sys, numpy as np; from maskfill import maskfill; '
+            'im = np.random.default_rng(0).random((50, 50)); maskfill(im, im > 0.9, method="distance"); '
+            'print(sorted(m for m in ["astropy", "scipy"] if m in sys.modules))')
+    root = str(Path(__file__).resolve().parents[1])
+    run = lambda code: subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=root, check=True).stdout
+    assert run(code).strip() == '[]'
+    code = ('import sys; sys.argv[1:] = ["--version"]\n'
+            'from maskfill.command_line import maskfill_cli\n'
+            'try:\n    maskfill_cli()\nexcept SystemExit:\n    print(sorted(m for m in ["astropy", "numpy", "scipy"] if m in sys.modules))')
+    version, modules = run(code).split('\n')[:2]
+    assert version == f'maskfill {importlib.import_module("maskfill").__version__}' and modules == '[]'
+    # maskfill.cli is the maskfill command line tool, as before the tools moved to maskfill.command_line
+    from maskfill import cli
+    import maskfill.command_line
+    assert cli is maskfill.command_line.maskfill_cli
+    # the package attribute `maskfill` stays the function after another export imports the submodule of that name
+    code = 'import types; from maskfill import run_batch; from maskfill import maskfill; print(isinstance(maskfill, types.FunctionType))'
+    assert run(code).strip() == 'True'